@@ -1,23 +1,78 @@
 """Build a book with Jupyter Notebooks and Sphinx."""
-from .toc import update_indexname, add_toctree
-from .yaml import add_yaml_config
-
 
 __version__ = "0.0.1dev0"
 
 
 # We connect this function to the step after the builder is initialized
 def setup(app):
-    app.connect("config-inited", update_indexname)
-    app.connect("source-read", add_toctree)
+    # Imported here so that the CLI can import this package without Sphinx
+    from .toc import update_indexname, AddTocTrees
+    from .yaml import add_yaml_config
+    from .manifest import find_changed_docs, skip_unchanged_docs, save_manifest
+    from .execute import execute_book_notebooks, note_dependencies
+    from .scope import keep_out_of_scope, limit_to_scope
+    from .profiling import (
+        init_profiler,
+        setup_profiler,
+        record_transforms,
+        MarkTransformsStart,
+    )
 
-    app.add_config_value("globaltoc_path", "toc.yml", "env")
+    # Profiling the build, with the paths to the report and the trace. This
+    # comes first so that loading the configuration and the TOC is recorded.
+    app.add_config_value("profile_path", "", "")
+    app.add_config_value("trace_path", "", "")
+    app.connect("config-inited", init_profiler)
+    app.connect("builder-inited", setup_profiler)
+    app.add_transform(MarkTransformsStart)
+    app.connect("doctree-read", record_transforms)
 
-    # configuration for YAML metadata
+    # configuration for YAML metadata, and the configuration once it's loaded
     app.add_config_value("yaml_config_path", "", "html")
+    app.add_config_value("yaml_config", None, "")
 
     app.connect("config-inited", add_yaml_config)
 
+    # The TOC is loaded after the YAML config, which replaces html_theme_options
+    app.connect("config-inited", update_indexname)
+    app.add_transform(AddTocTrees)
+
+    app.add_config_value("globaltoc_path", "toc.yml", "env")
+    # The TOC once it's loaded. Changes to the TOC that affect a page are
+    # tracked in the build manifest, so they don't re-read every page.
+    app.add_config_value("globaltoc", None, "")
+
+    # Only build some of the book's pages (a list of docnames), for example one
+    # page or a part of the TOC. This comes before notebooks are executed, so
+    # that only the notebooks of these pages are executed.
+    app.add_config_value("build_scope", [], "html")
+    app.connect("builder-inited", limit_to_scope)
+    app.connect("env-get-outdated", keep_out_of_scope)
+
+    # Execute notebooks in parallel before the pages are read. This is connected
+    # after MyST-NB, which sets the notebooks that can be executed.
+    app.add_config_value("execution_workers", 1, "")
+    # A build cache that executed notebooks are shared through
+    app.add_config_value("build_cache_url", "", "")
+    app.add_config_value("execution_kernel_pool", False, "")
+    app.add_config_value("execution_kernel_preload", [], "")
+    app.add_config_value("execution_kernel_max_notebooks", 10, "")
+    app.add_config_value("execution_kernel_setup", "", "")
+    app.add_config_value("execution_dependencies", {}, "")
+    app.add_config_value("execution_sandbox", False, "")
+    app.add_config_value("execution_outputs", {}, "")
+    app.add_config_value("execution_checkpoints", False, "")
+    app.add_config_value("execution_checkpoint_seconds", 10, "")
+    app.add_config_value("execution_checkpoints_kept", 2, "")
+    app.add_config_value("execution_report_cells", False, "")
+    app.connect("builder-inited", execute_book_notebooks)
+    app.connect("source-read", note_dependencies)
+
+    # Only re-read pages whose content changed since the last build
+    app.connect("env-get-outdated", find_changed_docs)
+    app.connect("env-before-read-docs", skip_unchanged_docs)
+    app.connect("env-updated", save_manifest)
+
     return {
         "version": __version__,
         "parallel_read_safe": True,
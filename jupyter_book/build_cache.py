@@ -0,0 +1,344 @@
+"""Share executed notebooks and builds between machines, with a build cache.
+
+A build cache stores bytes by key. The local caches of a book (the jupyter
+cache, the doctrees and the rendered pages) are only on the machine that built
+it, so a CI runner that starts from scratch executes every notebook and reads
+every page again. With a build cache, they are fetched from it instead:
+
+- each executed notebook is stored with a key from its code, the files it reads
+  and the versions of the tools that executed it (see `fingerprint`).
+- the doctrees and the rendered pages of the last build are stored together
+  (see `restore_build` and `save_build`). The build manifest then decides which
+  pages changed, from the hash of their content. Sphinx unpickles the
+  doctrees, so they're only shared through a cache that is trusted.
+
+A cache is either a folder (which can be shared between machines) or the URL
+of an HTTP server that answers GET and PUT requests for ``URL/KEY``.
+"""
+import io
+import json
+import logging
+import os
+import sys
+import tarfile
+import shutil
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from hashlib import sha256
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, url2pathname, urlopen
+
+LOGGER = logging.getLogger(__name__)
+
+# The time (in seconds) that HTTP requests to a build cache can take
+HTTP_TIMEOUT = 60
+
+
+class BuildCache(ABC):
+    """A build cache, which stores the data of binary files by key.
+
+    Data is read and written through files, so that a large build doesn't
+    have to fit in memory. A cache that can't be reached shouldn't stop a
+    build, so `get` and `put` log a warning and carry on instead of raising
+    errors.
+    """
+
+    @abstractmethod
+    def get(self, key, fileobj):
+        """Write the data stored for `key` to a binary file.
+
+        Returns whether it was stored. If it wasn't, or if it couldn't be read,
+        part of it may have been written.
+        """
+
+    @abstractmethod
+    def put(self, key, fileobj):
+        """Store the data of a binary file for `key`, replacing what was stored."""
+
+
+class DirectoryCache(BuildCache):
+    """A build cache in a folder, for example on a shared drive."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def __repr__(self):
+        return f"DirectoryCache({str(self.path)!r})"
+
+    def get(self, key, fileobj):
+        try:
+            with self.path.joinpath(key).open("rb") as ff:
+                shutil.copyfileobj(ff, fileobj)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as err:
+            LOGGER.warning(f"Can't read {key} from the build cache: {err}")
+            return False
+
+    def put(self, key, fileobj):
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            # Written to a temporary file first, so that other machines never
+            # read half of it
+            fd, path_tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as ff:
+                    shutil.copyfileobj(fileobj, ff)
+                os.replace(path_tmp, self.path.joinpath(key))
+            finally:
+                if os.path.exists(path_tmp):
+                    os.remove(path_tmp)
+        except OSError as err:
+            LOGGER.warning(f"Can't write {key} to the build cache: {err}")
+
+
+class HttpCache(BuildCache):
+    """A build cache on an HTTP server, at ``URL/KEY``.
+
+    Keys are read with GET requests, where a 404 means that nothing is stored,
+    and written with PUT requests.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def __repr__(self):
+        return f"HttpCache({self.url!r})"
+
+    def get(self, key, fileobj):
+        try:
+            with urlopen(f"{self.url}/{key}", timeout=HTTP_TIMEOUT) as response:
+                shutil.copyfileobj(response, fileobj)
+            return True
+        except HTTPError as err:
+            if err.code != 404:
+                LOGGER.warning(f"Can't read {key} from the build cache: {err}")
+            return False
+        except (URLError, OSError) as err:
+            LOGGER.warning(f"Can't read {key} from the build cache: {err}")
+            return False
+
+    def put(self, key, fileobj):
+        # urllib sends file objects in chunks, if it's given their length
+        length = fileobj.seek(0, io.SEEK_END) - fileobj.seek(0)
+        request = Request(
+            f"{self.url}/{key}",
+            data=fileobj,
+            method="PUT",
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(length),
+            },
+        )
+        try:
+            with urlopen(request, timeout=HTTP_TIMEOUT):
+                pass
+        except (URLError, OSError) as err:
+            LOGGER.warning(f"Can't write {key} to the build cache: {err}")
+
+
+def open_build_cache(url):
+    """Return the build cache at `url`.
+
+    Parameters
+    ----------
+    url : str
+        An ``http://`` or ``https://`` URL, a ``file://`` URL, or the path to a
+        folder.
+
+    Returns
+    -------
+    cache : BuildCache
+    """
+    parsed = urlparse(str(url))
+    if parsed.scheme in ("http", "https"):
+        return HttpCache(str(url))
+    if parsed.scheme == "file":
+        return DirectoryCache(url2pathname(parsed.path))
+    # Windows paths, such as C:\cache, have a one letter scheme
+    if len(parsed.scheme) <= 1:
+        return DirectoryCache(Path(url).absolute())
+    raise ValueError(
+        f"A build cache must be a folder or an http(s):// URL. Got '{url}'"
+    )
+
+
+def fingerprint():
+    """Return the versions of the tools that affect the outputs of a build.
+
+    They're part of every key, so that what was built with other versions of
+    the tools is never used.
+    """
+    import docutils
+    import jupyter_cache
+    import myst_nb
+    import nbformat
+    import sphinx
+    from . import __version__
+
+    versions = [
+        f"python={sys.version_info[0]}.{sys.version_info[1]}",
+        f"jupyter-book={__version__}",
+        f"sphinx={sphinx.__version__}",
+        f"myst-nb={myst_nb.__version__}",
+        f"jupyter-cache={jupyter_cache.__version__}",
+        f"docutils={docutils.__version__}",
+        f"nbformat={nbformat.__version__}",
+    ]
+    return "\n".join(versions)
+
+
+def notebook_key(path, nb, path_book=None, dependencies=None):
+    """Return the key of an executed notebook.
+
+    It comes from what the jupyter cache compares (the notebook's kernel, and
+    the code and metadata of its code cells), the notebook's path in the book,
+    the hash of the files it reads and the tools' versions.
+    """
+    path = Path(path).absolute()
+    path_rel = path.relative_to(Path(path_book).absolute()) if path_book else path.name
+    content = {
+        "fingerprint": fingerprint(),
+        "path": Path(path_rel).as_posix(),
+        "kernelspec": nb.metadata.get("kernelspec"),
+        "cells": [
+            [cell.source, cell.metadata]
+            for cell in nb.cells
+            if cell.cell_type == "code"
+        ],
+        "dependencies": dependencies,
+    }
+    text = json.dumps(content, sort_keys=True, default=repr)
+    return "notebook-" + sha256(text.encode("utf8")).hexdigest()
+
+
+def fetch_notebook(cache, key):
+    """Return an executed notebook and how long it took, or None if it isn't stored."""
+    import nbformat
+
+    data = io.BytesIO()
+    if not cache.get(key, data):
+        return None
+    try:
+        stored = json.loads(data.getvalue().decode("utf8"))
+        return nbformat.from_dict(stored["notebook"]), stored["seconds"]
+    except (ValueError, KeyError) as err:
+        LOGGER.warning(f"Ignoring {key} in the build cache, which can't be read: {err}")
+        return None
+
+
+def store_notebook(cache, key, nb, seconds):
+    """Store an executed notebook, and how long it took."""
+    stored = {"notebook": nb, "seconds": seconds}
+    cache.put(key, io.BytesIO(json.dumps(stored).encode("utf8")))
+
+
+def git_branch(path):
+    """Return the git branch that a folder is on, or "" if it isn't on one."""
+    import subprocess
+
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--abbrev-ref", "HEAD"],
+            cwd=str(path),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    branch = out.stdout.decode().strip()
+    # A detached HEAD, as in many CI checkouts, isn't a branch
+    return "" if branch == "HEAD" else branch
+
+
+def build_key(path_book, builder, paths_config=(), name=""):
+    """Return the key of the doctrees and pages of a book's builds.
+
+    Sphinx only keeps what it read from a book in the same folder, so the key
+    comes from the book's folder, the builder, the contents of the book's
+    configuration files (`paths_config`), a `name` such as a git branch, and
+    the tools' versions. Builds with the same key replace each other, and which
+    of their pages changed is decided from their content, by the build
+    manifest.
+    """
+    hashes = sha256()
+    for part in [fingerprint(), str(Path(path_book).absolute()), builder, name]:
+        hashes.update(sha256(part.encode("utf8")).digest())
+    for path in paths_config:
+        if Path(path).is_file():
+            hashes.update(sha256(Path(path).read_bytes()).digest())
+    return "build-" + hashes.hexdigest()
+
+
+def restore_build(cache, key, path_build, folders):
+    """Extract the folders of a build that was stored in the cache.
+
+    Sphinx unpickles the doctrees, which can run any code, so this must only be
+    used with a cache that only trusted machines can write to.
+
+    Parameters
+    ----------
+    cache : BuildCache
+    key : str
+        The key of the build (see `build_key`).
+    path_build : str | Path
+        The ``_build`` folder.
+    folders : list
+        The names of the folders of ``path_build`` that were stored.
+
+    Returns
+    -------
+    restored : bool
+        Whether the build was in the cache.
+    """
+    with tempfile.TemporaryFile() as data:
+        if not cache.get(key, data):
+            return False
+        data.seek(0)
+        return _extract_build(data, path_build, folders)
+
+
+def _extract_build(data, path_build, folders):
+    """Extract the folders of a build from a gzipped tar file."""
+    path_build = Path(path_build)
+    try:
+        with tarfile.open(fileobj=data, mode="r:gz") as tar:
+            members = [
+                member
+                for member in tar.getmembers()
+                if member.name.split("/")[0] in folders
+                and (member.isfile() or member.isdir())
+                and not Path(member.name).is_absolute()
+                and ".." not in Path(member.name).parts
+            ]
+            # Python versions with extraction filters warn without one
+            options = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+            tar.extractall(path_build, members=members, **options)
+    except (tarfile.TarError, OSError, EOFError) as err:
+        LOGGER.warning(f"Can't restore a build from the build cache: {err}")
+        return False
+
+    # The pages were rendered from the sources that are here now, if their
+    # hash didn't change, so they're made newer than the sources
+    now = time.time()
+    for member in members:
+        if member.isfile():
+            os.utime(path_build.joinpath(member.name), (now, now))
+    return True
+
+
+def save_build(cache, key, path_build, folders):
+    """Store the folders of a build in the cache, as a gzipped tar file."""
+    path_build = Path(path_build)
+    with tempfile.TemporaryFile() as data:
+        with tarfile.open(fileobj=data, mode="w:gz") as tar:
+            for folder in folders:
+                if path_build.joinpath(folder).is_dir():
+                    tar.add(str(path_build.joinpath(folder)), arcname=folder)
+        data.seek(0)
+        cache.put(key, data)
@@ -1,19 +1,17 @@
-"""Defines the commands that the CLI will use."""
+"""Defines the commands that the CLI will use.
+
+Each command imports the modules it needs when it is run, so that commands
+that don't build a book (and `--help`) don't have to import Sphinx.
+"""
 import sys
 import os
 import os.path as op
 from pathlib import Path
 import click
-from glob import glob
 import shutil as sh
-import subprocess
-from sphinx.util.osutil import cd
-import yaml
 
-from ..sphinx import build_sphinx
-from ..toc import build_toc
-from ..pdf import html_to_pdf
-from ..utils import _message_box, _error, init_myst_file
+from ..utils import _message_box, _error
+from .. import daemon as build_daemon
 
 
 @click.group()
@@ -36,14 +34,82 @@ BUILDER_OPTIONS = ["html", "pdfhtml", "latex", "pdflatex"]
     default="html",
     help="Which builder to use. Must be one of {BUILDER_OPTIONS}",
 )
-def build(path_book, path_output, config, toc, warningiserror, builder):
+@click.option(
+    "-j",
+    "--jobs",
+    default=None,
+    help="Number of parallel processes to read and write pages, or 'auto'.",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep running and rebuild pages when the book's files change.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Record how long each page takes to build, and report the slowest pages.",
+)
+@click.option(
+    "--trace",
+    default=None,
+    help="Path to write a timeline of the build to, as Chrome trace events.",
+)
+@click.option(
+    "--only",
+    multiple=True,
+    help="Only build this file of the TOC, with its sections. Can be repeated.",
+)
+@click.option(
+    "--cache-url",
+    default=None,
+    help="A folder or an http(s):// URL to share executed notebooks and builds.",
+)
+@click.option(
+    "--trust-cache",
+    is_flag=True,
+    help="Also share builds through --cache-url. Only use a cache that you trust.",
+)
+@click.option(
+    "--cache-key",
+    default=None,
+    help="A name for this build in the build cache. Defaults to the git branch.",
+)
+def build(
+    path_book,
+    path_output,
+    config,
+    toc,
+    warningiserror,
+    builder,
+    jobs,
+    watch,
+    profile,
+    trace,
+    only,
+    cache_url,
+    trust_cache,
+    cache_key,
+):
     """Convert your book's content to HTML or a PDF."""
+    # If a build daemon is running, it builds the book for us
+    if (
+        not watch
+        and not os.environ.get(build_daemon.ENV_NO_DAEMON)
+        and build_daemon.is_running()
+    ):
+        sys.exit(build_daemon.forward(_command_args(click.get_current_context())))
+
+    from copy import deepcopy
+    from ..config import load_config, load_toc, parse_jobs, toc_scope
+    from ..sphinx import CONFIG_FILES_CHANGED, build_sphinx
+    from ..profiling import trace_step
+
     # Paths for our notebooks
     PATH_BOOK = Path(path_book).absolute()
     if not PATH_BOOK.is_dir():
         _error(f"Path to book isn't a directory: {PATH_BOOK}")
 
-    book_config = {}
     builder_dict = {
         "html": "html",
         "pdfhtml": "singlehtml",
@@ -54,6 +120,8 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
         allowed_keys = tuple(builder_dict.keys())
         _error(f"Value for --builder must be one of {allowed_keys}. Got '{builder}'")
     sphinx_builder = builder_dict[builder]
+    if watch and builder != "html":
+        _error(f"--watch can only be used with the html builder. Got '{builder}'")
 
     # Table of contents
     if toc is None:
@@ -64,44 +132,12 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
                 f"Couldn't find a Table of Contents file. To auto-generate "
                 "one, run\n\n\tjupyter-book toc {path_book}"
             )
-    book_config["globaltoc_path"] = str(toc)
 
     # Configuration file
     if config is None:
         if PATH_BOOK.joinpath("_config.yml").exists():
             config = PATH_BOOK.joinpath("_config.yml")
 
-    extra_extensions = None
-    if config is not None:
-        book_config["yaml_config_path"] = str(config)
-        config_yaml = yaml.safe_load(config.read_text())
-        # Pop the extra extensions since we need to append, not replace
-        extra_extensions = config_yaml.pop("sphinx", {}).get("extra_extensions")
-        # Support Top Level config Passthrough
-        # https://www.sphinx-doc.org/en/latest/usage/configuration.html#project-information
-        sphinx_options = ["project", "author", "copyright"]
-        for option in sphinx_options:
-            if option in config_yaml.keys():
-                book_config[option] = config_yaml[option]
-
-    # Builder-specific overrides
-    latex_config = None
-    if builder == "pdfhtml":
-        book_config["html_theme_options"] = {"single_page": True}
-    if builder == "pdflatex":
-        if "latex" in config_yaml.keys():
-            latex_config = config_yaml.pop("latex")
-        if "title" in config_yaml.keys():
-            # Note: a latex_documents specified title takes precendence
-            # over a top level title
-            if (
-                latex_config is not None
-                and "title" not in latex_config["latex_documents"].keys()
-            ):
-                latex_config["latex_documents"]["title"] = config_yaml["title"]
-            else:
-                latex_config = {"latex_documents": {"title": config_yaml["title"]}}
-
     BUILD_PATH = path_output if path_output is not None else PATH_BOOK
     BUILD_PATH = Path(BUILD_PATH).joinpath("_build")
     if builder in ["html", "pdfhtml"]:
@@ -109,17 +145,114 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
     elif builder in ["latex", "pdflatex"]:
         OUTPUT_PATH = BUILD_PATH.joinpath("latex")
 
-    # Now call the Sphinx commands to build
-    exc = build_sphinx(
-        PATH_BOOK,
-        OUTPUT_PATH,
-        noconfig=True,
-        confoverrides=book_config,
-        latexoverrides=latex_config,
-        builder=sphinx_builder,
-        warningiserror=warningiserror,
-        extra_extensions=extra_extensions,
-    )
+    if trace is not None:
+        trace = Path(trace).absolute()
+
+    # With --watch, the build starts again from here when the configuration or
+    # the TOC changes, so that everything that comes from them is loaded again
+    while True:
+        book_config = {"globaltoc_path": str(toc)}
+        if config is not None:
+            book_config["yaml_config_path"] = str(config)
+
+        # Load the configuration and the TOC once, and pass them on to Sphinx
+        try:
+            book_config["yaml_config"], config_yaml = load_config(config)
+            book_config["globaltoc"] = load_toc(toc)
+            if only:
+                book_config["build_scope"] = toc_scope(book_config["globaltoc"], only)
+        except ValueError as err:
+            _error(str(err))
+
+        extra_extensions = None
+        if config is not None:
+            # The extra extensions are passed separately since we need to append,
+            # not replace
+            extra_extensions = config_yaml.get("sphinx", {}).get("extra_extensions")
+            # Support Top Level config Passthrough
+            # https://www.sphinx-doc.org/en/latest/usage/configuration.html#project-information
+            sphinx_options = ["project", "author", "copyright"]
+            for option in sphinx_options:
+                if option in config_yaml.keys():
+                    book_config[option] = config_yaml[option]
+
+        # Builder-specific overrides
+        latex_config = None
+        if builder == "pdfhtml":
+            book_config["html_theme_options"] = {"single_page": True}
+        if builder == "pdflatex":
+            if "latex" in config_yaml.keys():
+                latex_config = deepcopy(config_yaml["latex"])
+            if "title" in config_yaml.keys():
+                # Note: a latex_documents specified title takes precendence
+                # over a top level title
+                if (
+                    latex_config is not None
+                    and "title" not in latex_config["latex_documents"].keys()
+                ):
+                    latex_config["latex_documents"]["title"] = config_yaml["title"]
+                else:
+                    latex_config = {"latex_documents": {"title": config_yaml["title"]}}
+
+        # Parallel builds, the command-line flags take precedence over the config
+        config_build = config_yaml.get("build", {})
+        try:
+            build_jobs = parse_jobs(
+                jobs if jobs is not None else config_build.get("jobs")
+            )
+        except ValueError as err:
+            _error(str(err))
+        build_cache_url = (
+            cache_url if cache_url is not None else config_build.get("cache_url")
+        )
+        build_trusted = trust_cache or config_build.get("cache_trusted", False)
+
+        # Start from the last build in the build cache, if there isn't one here.
+        # Sphinx unpickles the doctrees, so builds are only shared if the cache
+        # is trusted.
+        build_cache = None
+        if build_cache_url:
+            from ..build_cache import build_key, git_branch, open_build_cache
+            from ..build_cache import restore_build
+
+            try:
+                build_cache = open_build_cache(build_cache_url)
+            except ValueError as err:
+                _error(str(err))
+            book_config["build_cache_url"] = build_cache_url
+        if build_cache is not None and build_trusted:
+            cached_folders = [".doctrees", OUTPUT_PATH.name]
+            cached_build = build_key(
+                PATH_BOOK,
+                builder,
+                [toc, config] if config is not None else [toc],
+                cache_key if cache_key is not None else git_branch(PATH_BOOK),
+            )
+            if not BUILD_PATH.joinpath(".doctrees", "environment.pickle").exists():
+                if restore_build(build_cache, cached_build, BUILD_PATH, cached_folders):
+                    print(
+                        "Restored the last build from the build cache: "
+                        f"{build_cache_url}"
+                    )
+
+        # Now call the Sphinx commands to build
+        exc = build_sphinx(
+            PATH_BOOK,
+            OUTPUT_PATH,
+            noconfig=True,
+            confoverrides=book_config,
+            latexoverrides=latex_config,
+            builder=sphinx_builder,
+            warningiserror=warningiserror,
+            extra_extensions=extra_extensions,
+            jobs=build_jobs,
+            watch=watch,
+            profile=profile,
+            trace=trace,
+        )
+        if exc is not CONFIG_FILES_CHANGED:
+            break
+        print("Configuration changed, restarting the build...")
 
     if exc:
         _error(
@@ -127,6 +260,13 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
             "Look above for the error message."
         )
     else:
+        # Builds of some of the pages aren't shared, since they'd have to be
+        # completed by the next build
+        if build_cache is not None and build_trusted and not only and not watch:
+            from ..build_cache import save_build
+
+            save_build(build_cache, cached_build, BUILD_PATH, cached_folders)
+
         # Builder-specific options
         if builder == "html":
             path_output_rel = Path(op.relpath(OUTPUT_PATH, Path()))
@@ -146,12 +286,15 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
             """
             )
         if builder == "pdfhtml":
+            from ..pdf import html_to_pdf
+
             print("Finished generating HTML for book...")
             print("Converting book HTML into PDF...")
             path_pdf_output = OUTPUT_PATH.parent.joinpath("pdf")
             path_pdf_output.mkdir(exist_ok=True)
             path_pdf_output = path_pdf_output.joinpath("book.pdf")
-            html_to_pdf(OUTPUT_PATH.joinpath("index.html"), path_pdf_output)
+            with trace_step(trace, "html_to_pdf"):
+                html_to_pdf(OUTPUT_PATH.joinpath("index.html"), path_pdf_output)
             path_pdf_output_rel = Path(op.relpath(path_pdf_output, Path()))
             _message_box(
                 f"""\
@@ -161,6 +304,9 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
             """
             )
         if builder == "pdflatex":
+            import subprocess
+            from sphinx.util.osutil import cd
+
             print("Finished generating latex for book...")
             print("Converting book latex into PDF...")
             # Convert to PDF via tex and template built Makefile and make.bat
@@ -169,7 +315,7 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
             else:
                 makecmd = os.environ.get("MAKE", "make")
             try:
-                with cd(OUTPUT_PATH):
+                with cd(OUTPUT_PATH), trace_step(trace, "latex_to_pdf"):
                     subprocess.run([makecmd, "all-pdf"])
                 _message_box(
                     f"""\
@@ -183,6 +329,29 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
                 return 1
 
 
+def _command_args(ctx):
+    """Return the command-line arguments that run a command with its parameters.
+
+    They're built from what click parsed, rather than `sys.argv`, so that they're
+    the same when the command is called with `main(args=...)`.
+    """
+    options = []
+    arguments = []
+    for param in ctx.command.params:
+        value = ctx.params.get(param.name)
+        if value is None or value is False or value == ():
+            continue
+        if isinstance(param, click.Argument):
+            arguments.append(str(value))
+        elif param.is_flag:
+            options.append(param.opts[-1])
+        else:
+            for item in value if param.multiple else [value]:
+                options.extend([param.opts[-1], str(item)])
+    # Arguments that start with "-" aren't taken for options
+    return [ctx.info_name] + options + ["--"] + arguments
+
+
 @main.command()
 @click.argument("path-page")
 @click.option("--path-output", default=None, help="Path to the output artifacts")
@@ -191,6 +360,9 @@ def build(path_book, path_output, config, toc, warningiserror, builder):
 def page(path_page, path_output, config, execute):
     """Convert a single content file to HTML or PDF.
     """
+    from ..config import load_config
+    from ..sphinx import build_sphinx
+
     # Paths for our notebooks
     PATH_PAGE = Path(path_page)
     PATH_PAGE_FOLDER = PATH_PAGE.parent.absolute()
@@ -203,21 +375,25 @@ def page(path_page, path_output, config, execute):
     OUTPUT_PATH = path_output if path_output is not None else PATH_PAGE_FOLDER
     OUTPUT_PATH = Path(OUTPUT_PATH).joinpath("_build/html")
 
-    # Find all files that *aren't* the page we're building and exclude them
-    to_exclude = glob(str(PATH_PAGE_FOLDER.joinpath("**", "*")), recursive=True)
-    to_exclude = [
-        op.relpath(ifile, PATH_PAGE_FOLDER)
-        for ifile in to_exclude
-        if ifile != str(PATH_PAGE.absolute())
-    ]
-    to_exclude.extend(["_build", "Thumbs.db", ".DS_Store", "**.ipynb_checkpoints"])
+    try:
+        yaml_config, _ = load_config(config or None)
+    except ValueError as err:
+        _error(str(err))
 
     # Now call the Sphinx commands to build
     config = {
         "master_doc": PAGE_NAME,
         "yaml_config_path": config,
+        "yaml_config": yaml_config,
         "globaltoc_path": "",
-        "exclude_patterns": to_exclude,
+        "exclude_patterns": [
+            "_build",
+            "Thumbs.db",
+            ".DS_Store",
+            "**.ipynb_checkpoints",
+        ],
+        # Only the page is looked at, not the other files in its folder
+        "build_scope": [PAGE_NAME],
         "jupyter_execute_notebooks": execute,
         "html_theme_options": {"single_page": True},
     }
@@ -235,6 +411,143 @@ def page(path_page, path_output, config, execute):
     _message_box(f"Page build finished. Open your page at:\n\n    {path_page}")
 
 
+@main.command()
+@click.argument("path-book")
+@click.option("--path-output", default=None, help="Path to the output artifacts")
+@click.option("--config", default=None, help="Path to the YAML configuration file")
+@click.option("--toc", default=None, help="Path to the Table of Contents YAML file")
+@click.option(
+    "-j",
+    "--workers",
+    default=None,
+    type=int,
+    help="Number of notebooks to execute at the same time.",
+)
+@click.option(
+    "--shard",
+    default=None,
+    help="Only execute one part of the notebooks, e.g. '2/4' for the second of four.",
+)
+@click.option(
+    "--cache-url",
+    default=None,
+    help="A folder or an http(s):// URL to share executed notebooks through.",
+)
+def execute(path_book, path_output, config, toc, workers, shard, cache_url):
+    """Execute your book's notebooks and store their outputs in the cache.
+
+    The book isn't built, so notebooks can be executed (for example, split
+    across several CI jobs with --shard) before the book is built from the cache.
+    """
+    import logging
+    from ..build_cache import open_build_cache
+    from ..config import load_config, load_toc
+    from ..execute import (
+        checkpoint_options,
+        execute_notebooks,
+        find_book_notebooks,
+        kernel_pool_options,
+        write_execution_report,
+    )
+
+    PATH_BOOK = Path(path_book).absolute()
+    if not PATH_BOOK.is_dir():
+        _error(f"Path to book isn't a directory: {PATH_BOOK}")
+    if toc is None:
+        toc = PATH_BOOK.joinpath("_toc.yml")
+    if config is None and PATH_BOOK.joinpath("_config.yml").exists():
+        config = PATH_BOOK.joinpath("_config.yml")
+
+    try:
+        yaml_config, _ = load_config(config)
+        book_toc = load_toc(toc)
+        if cache_url is None:
+            cache_url = yaml_config["build"].get("cache_url")
+        build_cache = open_build_cache(cache_url) if cache_url else None
+    except ValueError as err:
+        _error(str(err))
+
+    execute_config = yaml_config["execute"]
+    paths = find_book_notebooks(
+        PATH_BOOK, book_toc, execute_config.get("exclude_patterns") or []
+    )
+    if shard is not None:
+        try:
+            index, n_shards = [int(ii) for ii in shard.split("/")]
+        except ValueError:
+            index, n_shards = 0, 0
+        if not 1 <= index <= n_shards:
+            _error(f"--shard must look like '2/4' (the second of four). Got '{shard}'")
+        paths = paths[index - 1 :: n_shards]
+
+    # The same cache as `jupyter-book build`
+    BUILD_PATH = path_output if path_output is not None else PATH_BOOK
+    path_cache = execute_config.get("cache") or Path(BUILD_PATH).joinpath(
+        "_build", ".jupyter_cache"
+    )
+    if workers is None:
+        workers = execute_config["workers"]
+    elif workers <= 0:
+        _error(f"--workers must be a positive integer. Got '{workers}'")
+
+    # Show the progress of execution
+    logger = logging.getLogger("jupyter_book")
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.INFO)
+    kernel_pool = kernel_pool_options(
+        execute_config.get("kernel_pool"),
+        execute_config.get("kernel_preload"),
+        execute_config.get("kernel_max_notebooks", 10),
+    )
+    results = execute_notebooks(
+        paths,
+        path_cache,
+        workers=workers,
+        kernel_pool=kernel_pool,
+        path_book=PATH_BOOK,
+        dependencies=execute_config.get("dependencies"),
+        sandbox=execute_config.get("sandbox", False),
+        outputs=execute_config.get("outputs"),
+        checkpoints=checkpoint_options(
+            execute_config.get("checkpoints"),
+            execute_config.get("checkpoint_seconds", 10),
+            execute_config.get("checkpoints_kept", 2),
+        ),
+        kernel_setup=(
+            op.join(PATH_BOOK, execute_config["kernel_setup"])
+            if execute_config.get("kernel_setup")
+            else None
+        ),
+        stream=sys.stdout,
+        build_cache=build_cache,
+    )
+
+    if any(result["status"] != "cached" for result in results):
+        write_execution_report(
+            Path(BUILD_PATH).joinpath("_build", "reports", "execution.json"),
+            results,
+            PATH_BOOK,
+            cells=execute_config.get("report_cells", False),
+            logger=logger,
+        )
+
+    counts = {"cached": 0, "succeeded": 0, "failed": 0}
+    lines = []
+    for result in sorted(results, key=lambda result: str(result["path"])):
+        counts[result["status"]] += 1
+        seconds = "" if result["seconds"] is None else f"{result['seconds']:.1f}s"
+        path_rel = op.relpath(result["path"], PATH_BOOK)
+        lines.append(f"{result['status']:<10}{seconds:>10}  {path_rel}")
+    summary = (
+        f"{counts['cached']} notebooks were in the cache, "
+        f"{counts['succeeded'] + counts['failed']} were executed "
+        f"({counts['failed']} failed).\n\n" + "\n".join(lines)
+    )
+    if counts["failed"]:
+        _error(summary)
+    _message_box(f"{summary}\n\nThe outputs are cached in:\n\n    {path_cache}")
+
+
 @main.command()
 @click.argument("path-book")
 def create(path_book):
@@ -271,6 +584,8 @@ def toc(path, filename_split_char, skip_text, output_folder):
     order of pages/sections. If any file is called "index.{extension}", it will be
     chosen as the first file.
     """
+    from ..utils import build_toc
+
     out_yaml = build_toc(path, filename_split_char, skip_text)
     if output_folder is None:
         output_folder = path
@@ -312,6 +627,36 @@ def clean(path_book, all_):
         )
 
 
+@main.group()
+def daemon():
+    """Run builds in a server that keeps Jupyter Book's dependencies imported."""
+    pass
+
+
+@daemon.command()
+def start():
+    """Start the build daemon. `jb build` uses it while it is running.
+
+    The daemon runs until it is stopped with `jupyter-book daemon stop` or
+    Ctrl-C. Set JUPYTER_BOOK_DAEMON to change the path of its socket, and
+    JUPYTER_BOOK_NO_DAEMON to build books without it.
+    """
+    path_socket = build_daemon.get_socket_path()
+    _message_box(f"Starting the Jupyter Book daemon at:\n\n    {path_socket}")
+    try:
+        build_daemon.serve(path_socket)
+    except (OSError, ValueError) as exc:
+        _error(str(exc))
+
+
+@daemon.command()
+def stop():
+    """Stop the build daemon."""
+    if not build_daemon.stop():
+        _error("The Jupyter Book daemon isn't running.")
+    _message_box("The Jupyter Book daemon has been stopped.")
+
+
 @main.group()
 def myst():
     """Manipulate MyST markdown files."""
@@ -326,5 +671,7 @@ def myst():
 def init(path, kernel):
     """Add Jupytext metadata for your markdown file(s), with optional Kernel name.
     """
+    from ..utils import init_myst_file
+
     for ipath in path:
         init_myst_file(ipath, kernel, verbose=True)
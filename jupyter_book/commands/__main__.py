@@ -0,0 +1,5 @@
+"""Run the command-line interface with `python -m jupyter_book.commands`."""
+from . import main
+
+if __name__ == "__main__":
+    main(prog_name="jupyter-book")
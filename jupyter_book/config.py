@@ -0,0 +1,159 @@
+"""Load a book's configuration and table of contents.
+
+Both files are loaded once per build, by the command-line interface, and the
+loaded values are passed to the Sphinx extension so that every step of the build
+uses the same configuration.
+"""
+from pathlib import Path
+
+import yaml
+
+PATH_YAML_DEFAULT = Path(__file__).parent.joinpath("default_config.yml")
+
+# libyaml's loader is much faster than the pure-Python one, if it's installed
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def load_yaml(path):
+    """Load a YAML file, with only the standard YAML tags allowed."""
+    return yaml.load(Path(path).read_text(), Loader=YamlLoader)
+
+
+def load_config(path_config=None):
+    """Load a book's configuration, and merge it into the default configuration.
+
+    Parameters
+    ----------
+    path_config : str | Path | None
+        Path to the book's `_config.yml`. If None, the default configuration is
+        used.
+
+    Returns
+    -------
+    config : dict
+        The default configuration, updated with the book's configuration.
+    config_user : dict
+        The book's configuration, as it is written in `path_config`.
+
+    Raises
+    ------
+    ValueError
+        If `path_config` doesn't exist, or a value in it isn't valid.
+    """
+    config = load_yaml(PATH_YAML_DEFAULT)
+    if path_config is None:
+        return config, {}
+
+    path_config = Path(path_config)
+    if not path_config.exists():
+        raise ValueError(
+            f"Path to a _config.yml file was given, but not found: {path_config}"
+        )
+    config_user = load_yaml(path_config) or {}
+    for key, val in config_user.items():
+        # If it's a dictionary, we should just updated the newly-given values
+        if isinstance(config.get(key), dict):
+            config[key].update(val)
+        else:
+            config[key] = val
+    execute = config["execute"]
+    execute["workers"] = parse_jobs(execute.get("workers"), "execute.workers")
+    return config, config_user
+
+
+def parse_jobs(jobs, name="jobs"):
+    """Convert a `jobs` value ("auto", an int, or None) to a number of processes.
+
+    `name` is the name of the value in the error that is raised if it isn't a
+    positive integer or "auto".
+    """
+    import multiprocessing
+
+    if jobs is None:
+        return 1
+    if str(jobs).lower() == "auto":
+        return multiprocessing.cpu_count()
+    try:
+        count = int(jobs)
+    except (TypeError, ValueError):
+        count = 0
+    if count <= 0:
+        raise ValueError(f"{name} must be a positive integer or 'auto', got: {jobs}")
+    return count
+
+
+def load_toc(path_toc):
+    """Load a book's table of contents.
+
+    If the TOC is a flat list, its first page is treated as the book's first
+    page, and the other pages become its sections.
+    """
+    path_toc = Path(path_toc)
+    if not path_toc.exists():
+        raise ValueError(
+            f"You gave a Table of Contents file path that doesn't exist: {path_toc}"
+        )
+    if path_toc.suffix not in [".yml", ".yaml"]:
+        raise ValueError(
+            "You gave a Table of Contents file path that is not a YAML file: "
+            f"{path_toc}"
+        )
+
+    toc = load_yaml(path_toc)
+    if isinstance(toc, list):
+        toc_updated = toc[0]
+        if len(toc) > 1:
+            toc_updated["sections"] = toc[1:]
+        toc = toc_updated
+    return toc
+
+
+def toc_scope(toc, files):
+    """Return the `file` entries of a TOC that are built to build some of them.
+
+    Each file is built with the files in its sections, and the files that lead
+    to it from the first file, so that it's part of the book's navigation.
+
+    Parameters
+    ----------
+    toc : dict
+        A loaded TOC.
+    files : list
+        `file` entries of the TOC. Their suffix is optional.
+
+    Returns
+    -------
+    scope : list
+        The `file` entries to build, without suffixes, in the order of the TOC.
+    """
+
+    def _no_suffix(file):
+        return str(Path(file).with_suffix("").as_posix())
+
+    wanted = {_no_suffix(file) for file in files}
+    scope = set()
+
+    def _visit(entry, ancestors):
+        if "file" in entry:
+            file = _no_suffix(entry["file"])
+            if file in wanted:
+                scope.update(ancestors)
+                scope.update(_no_suffix(sub) for sub in toc_files(entry))
+            ancestors = ancestors + [file]
+        for section in entry.get("sections", []):
+            _visit(section, ancestors)
+
+    _visit(toc, [])
+    missing = wanted - scope
+    if missing:
+        raise ValueError(f"Files aren't in the Table of Contents: {sorted(missing)}")
+    files = [_no_suffix(file) for file in toc_files(toc)]
+    return [file for file in files if file in scope]
+
+
+def toc_files(toc):
+    """Return the `file` entries of a loaded TOC, in the order they're read."""
+    files = [toc["file"]] if "file" in toc else []
+    for section in toc.get("sections", []):
+        files.extend(toc_files(section))
+    return files
@@ -0,0 +1,285 @@
+"""A local build server that keeps Jupyter Book's dependencies imported.
+
+`jb daemon start` imports Sphinx, the Sphinx extensions used by Jupyter Book and
+their dependencies once, then waits for commands on a Unix socket. When the
+daemon is running, `jb build` sends its arguments to it instead of building the
+book itself. Each command runs in a process forked from the daemon, so it starts
+with everything already imported, and builds can't affect each other.
+
+Messages are JSON objects, one per line. The client sends one request with the
+command-line arguments, working directory and the environment variables that
+builds need (see `FORWARDED_ENV`). The daemon replies with the command's output
+as ``{"stream": ..., "text": ...}`` messages, followed by ``{"exit": <exit code>}``.
+
+The socket is in a folder that only its user can access, and only its user can
+connect to it. Clients only send commands to a socket that belongs to them.
+"""
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import traceback
+from importlib import import_module
+from pathlib import Path
+
+# Setting this environment variable stops `jb build` from using the daemon
+ENV_NO_DAEMON = "JUPYTER_BOOK_NO_DAEMON"
+# This environment variable changes the path of the daemon's socket
+ENV_SOCKET = "JUPYTER_BOOK_DAEMON"
+
+# The environment variables that are sent to the daemon with each build. Others,
+# which may be secrets, are the daemon's own, from when it was started.
+FORWARDED_ENV = [
+    "PATH",
+    "HOME",
+    "LANG",
+    "LANGUAGE",
+    "TERM",
+    "TZ",
+    "PYTHONPATH",
+    "VIRTUAL_ENV",
+    "CONDA_PREFIX",
+    "CONDA_DEFAULT_ENV",
+    "SOURCE_DATE_EPOCH",
+]
+FORWARDED_ENV_PREFIXES = ("LC_", "JUPYTER", "SPHINX")
+
+# Modules that are imported by the daemon before it accepts builds
+PRELOAD_MODULES = [
+    "sphinx.application",
+    "sphinx.builders.html",
+    "sphinx.builders.latex",
+    "sphinx.builders.singlehtml",
+    "nbformat",
+    "nbclient",
+    "yaml",
+    "jupyter_book.sphinx",
+    "jupyter_book.commands",
+]
+
+
+def get_socket_path():
+    """Return the path of the daemon's socket.
+
+    It's in the user's runtime folder, or else in a folder of the temporary
+    folder that only the user can access.
+    """
+    if os.environ.get(ENV_SOCKET):
+        return Path(os.environ[ENV_SOCKET])
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        folder = Path(os.environ["XDG_RUNTIME_DIR"])
+    else:
+        uid = os.getuid() if hasattr(os, "getuid") else "user"
+        folder = Path(tempfile.gettempdir()).joinpath(f"jupyter-book-{uid}")
+        try:
+            folder.mkdir(mode=0o700)
+        except FileExistsError:
+            pass
+        except OSError:
+            # For example, if the temporary folder is read-only. The folder is
+            # checked before the socket is used anyway
+            pass
+    return folder.joinpath("jupyter-book.sock")
+
+
+def _is_private(path):
+    """Return whether a file belongs to this user, and only this user can use it."""
+    try:
+        info = os.lstat(str(path))
+    except OSError:
+        return False
+    if hasattr(os, "getuid") and info.st_uid != os.getuid():
+        return False
+    return not stat.S_IMODE(info.st_mode) & 0o077
+
+
+def _connect(path_socket):
+    """Return a socket connected to the daemon, or None if it isn't running.
+
+    Sockets that belong to other users, or that they can use, aren't connected
+    to, since commands are sent with the current folder and the environment.
+    """
+    if not hasattr(socket, "AF_UNIX") or not Path(path_socket).exists():
+        return None
+    if not stat.S_ISSOCK(os.lstat(str(path_socket)).st_mode):
+        return None
+    if not _is_private(path_socket):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path_socket))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def is_running(path_socket=None):
+    """Return whether a daemon is accepting commands on `path_socket`."""
+    if path_socket is None:
+        path_socket = get_socket_path()
+    sock = _connect(path_socket)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def forward(args, path_socket=None):
+    """Run a `jupyter-book` command in the daemon, and return its exit code.
+
+    The command's output is written to this process's stdout and stderr.
+    """
+    if path_socket is None:
+        path_socket = get_socket_path()
+    sock = _connect(path_socket)
+    if sock is None:
+        raise ConnectionError(f"The Jupyter Book daemon isn't running: {path_socket}")
+
+    with sock, sock.makefile("rw", encoding="utf8") as stream:
+        env = {
+            name: value
+            for name, value in os.environ.items()
+            if name in FORWARDED_ENV or name.startswith(FORWARDED_ENV_PREFIXES)
+        }
+        request = {"args": list(args), "cwd": os.getcwd(), "env": env}
+        stream.write(json.dumps(request) + "\n")
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+            output = sys.stderr if message["stream"] == "stderr" else sys.stdout
+            output.write(message["text"])
+            output.flush()
+    # The daemon closed the connection without finishing the command
+    return 1
+
+
+def stop(path_socket=None):
+    """Ask the daemon to stop. Returns False if it wasn't running."""
+    if path_socket is None:
+        path_socket = get_socket_path()
+    sock = _connect(path_socket)
+    if sock is None:
+        return False
+    with sock, sock.makefile("rw", encoding="utf8") as stream:
+        stream.write(json.dumps({"stop": True}) + "\n")
+        stream.flush()
+        stream.readline()
+    return True
+
+
+class _MessageWriter(io.TextIOBase):
+    """A text stream that sends everything written to it as daemon messages."""
+
+    def __init__(self, wfile, name):
+        self._wfile = wfile
+        self.name = name
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def write(self, text):
+        message = json.dumps({"stream": self.name, "text": text}) + "\n"
+        self._wfile.write(message.encode("utf8"))
+        self._wfile.flush()
+        return len(text)
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    """Run one `jupyter-book` command. This runs in a forked process."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # A connection that only checks whether the daemon is running
+            return
+        request = json.loads(line)
+        if request.get("stop"):
+            os.kill(os.getppid(), signal.SIGTERM)
+            self._send({"exit": 0})
+            return
+
+        # Run the command as if it was run from the client
+        os.chdir(request["cwd"])
+        os.environ.update(request["env"])
+        os.environ[ENV_NO_DAEMON] = "1"
+        sys.stdout = _MessageWriter(self.wfile, "stdout")
+        sys.stderr = _MessageWriter(self.wfile, "stderr")
+
+        import click
+        from .commands import main
+
+        try:
+            main.main(args=request["args"], prog_name="jb", standalone_mode=False)
+            code = 0
+        except click.ClickException as exc:
+            exc.show()
+            code = exc.exit_code
+        except SystemExit as exc:
+            code = exc.code if isinstance(exc.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._send({"exit": code})
+
+    def _send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf8"))
+        self.wfile.flush()
+
+
+class _DaemonServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def serve(path_socket=None):
+    """Import Jupyter Book's dependencies, then run commands sent to `path_socket`.
+
+    This blocks until the daemon is stopped with `stop`, SIGTERM or Ctrl-C.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise OSError("The Jupyter Book daemon requires Unix sockets.")
+    if path_socket is None:
+        path_socket = get_socket_path()
+    path_socket = Path(path_socket)
+    if is_running(path_socket):
+        raise ValueError(f"A Jupyter Book daemon is already running: {path_socket}")
+    if path_socket.exists():
+        # Left behind by a daemon that didn't exit cleanly
+        path_socket.unlink()
+
+    from .sphinx import DEFAULT_CONFIG
+
+    for module in PRELOAD_MODULES + DEFAULT_CONFIG["extensions"]:
+        try:
+            import_module(module)
+        except ImportError:
+            pass
+
+    # Stop cleanly when `stop` sends SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Only this user can connect to the socket, from when it's created
+    umask = os.umask(0o177)
+    try:
+        server = _DaemonServer(str(path_socket), _CommandHandler)
+    finally:
+        os.umask(umask)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if path_socket.exists():
+            path_socket.unlink()
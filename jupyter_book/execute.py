@@ -0,0 +1,1675 @@
+"""Execute a book's notebooks in parallel, and store their outputs in the cache.
+
+MyST-NB executes the notebooks that aren't in the jupyter cache one at a time,
+while Sphinx reads the book. Instead, the notebooks that aren't in the cache are
+executed here in a pool of processes before the book is read, each with its own
+kernel. Their outputs are then stored in the cache, where MyST-NB finds them.
+"""
+
+import heapq
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from hashlib import sha256
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+# Whether `_log_without_psutil` has logged already
+_LOGGED_WITHOUT_PSUTIL = False
+
+# The number of notebooks in the table of the slowest notebooks
+N_SLOWEST = 20
+# How often (in seconds) progress is logged, when it isn't shown on a terminal
+PROGRESS_INTERVAL = 60
+
+
+def read_notebook(path):
+    """Read a notebook, either an `.ipynb` file or a MyST Markdown notebook."""
+    from myst_nb.converter import path_to_notebook
+
+    return path_to_notebook(str(path))
+
+
+def is_notebook(path):
+    """Return whether a file is a notebook that can be executed."""
+    from myst_nb.converter import is_myst_file
+
+    return is_myst_file(str(path))
+
+
+def find_book_notebooks(path_book, toc, exclude_patterns=()):
+    """Return the paths of the notebooks in a book's TOC that can be executed.
+
+    Parameters
+    ----------
+    path_book : str | Path
+        Path to the book's folder.
+    toc : dict
+        The book's table of contents, as returned by `load_toc`.
+    exclude_patterns : list
+        Glob patterns of the notebooks that shouldn't be executed.
+
+    Returns
+    -------
+    paths : list
+        Paths to the notebooks, in the order of the TOC.
+    """
+    from .config import toc_files
+    from .utils import SUPPORTED_FILE_SUFFIXES
+
+    path_book = Path(path_book).absolute()
+    excluded = {
+        path.absolute()
+        for pattern in exclude_patterns
+        for path in path_book.rglob(pattern)
+    }
+    paths = []
+    for entry in toc_files(toc):
+        path = path_book.joinpath(entry)
+        if not path.is_file():
+            # TOC entries usually don't have a suffix
+            candidates = [
+                path.with_name(path.name + suffix) for suffix in SUPPORTED_FILE_SUFFIXES
+            ]
+            path = next((cand for cand in candidates if cand.is_file()), None)
+        if path is None or path in excluded or path in paths:
+            continue
+        if is_notebook(path):
+            paths.append(path)
+    return paths
+
+
+def _kernel_pid(km):
+    """Return the process id of a kernel, or None if it isn't known."""
+    if getattr(km, "pid", None) is not None:
+        # Kernels forked from a template
+        return km.pid
+    # `provisioner` is new in jupyter_client 7
+    process = getattr(getattr(km, "provisioner", None), "process", None)
+    return getattr(process or getattr(km, "kernel", None), "pid", None)
+
+
+def _log_without_psutil(logger):
+    """Log that CPU time and memory aren't measured, if psutil isn't installed.
+
+    This is only logged once per process, rather than for each kernel.
+    """
+    global _LOGGED_WITHOUT_PSUTIL
+    if _LOGGED_WITHOUT_PSUTIL:
+        return
+    try:
+        import psutil  # noqa F401
+    except ImportError:
+        logger.info(
+            "psutil isn't installed, so the CPU time and memory that notebooks use "
+            "aren't measured. To measure them, install jupyter-book[report]"
+        )
+        _LOGGED_WITHOUT_PSUTIL = True
+
+
+class ResourceUsage:
+    """Measure the time, CPU time and memory that a kernel uses to run cells.
+
+    CPU time and memory are only measured if psutil is installed. Memory is
+    the peak resident set size (RSS) of the kernel's process, which is sampled
+    while each cell runs.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = None
+        self.cells = []
+
+    def watch(self, km):
+        """Measure the kernel of a kernel manager."""
+        pid = _kernel_pid(km)
+        try:
+            import psutil
+        except ImportError:
+            return
+        if pid is not None:
+            try:
+                self.process = psutil.Process(pid)
+            except psutil.Error:
+                self.process = None
+
+    def _measure(self, method):
+        if self.process is None:
+            return None
+        try:
+            return method(self.process)
+        except Exception:
+            # The kernel died
+            return None
+
+    def _cpu_seconds(self):
+        return self._measure(lambda process: sum(process.cpu_times()[:2]))
+
+    def _rss(self):
+        return self._measure(lambda process: process.memory_info().rss)
+
+    @contextmanager
+    def cell(self, index):
+        """Measure the resources that a cell uses while it runs."""
+        peak = [self._rss()]
+        stopped = threading.Event()
+
+        def sample():
+            while not stopped.wait(self.interval):
+                rss = self._rss()
+                if rss is not None:
+                    peak[0] = max(peak[0] or 0, rss)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        if self.process is not None:
+            sampler.start()
+        start = time.perf_counter()
+        cpu_start = self._cpu_seconds()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_end = self._cpu_seconds()
+            stopped.set()
+            if sampler.is_alive():
+                sampler.join()
+            self.cells.append(
+                {
+                    "index": index,
+                    "seconds": seconds,
+                    "cpu_seconds": (
+                        None if None in (cpu_start, cpu_end) else cpu_end - cpu_start
+                    ),
+                    "peak_rss": peak[0],
+                }
+            )
+
+    def summary(self):
+        """Return the CPU time and peak memory of every cell, and of each cell."""
+        cpu = [cell["cpu_seconds"] for cell in self.cells]
+        rss = [cell["peak_rss"] for cell in self.cells if cell["peak_rss"]]
+        return {
+            "cpu_seconds": None if not cpu or None in cpu else sum(cpu),
+            "peak_rss": max(rss, default=None),
+            "cells": self.cells,
+        }
+
+
+def _execute_cells(client, nb, usage):
+    """Execute every cell of a notebook with a client, measuring each cell."""
+    for index, cell in enumerate(nb.cells):
+        # Only code cells are run
+        if cell.cell_type != "code":
+            continue
+        with usage.cell(index):
+            client.execute_cell(
+                cell, index, execution_count=client.code_cells_executed + 1
+            )
+
+
+class WarmKernel:
+    """A kernel that is kept running to execute several notebooks in turn.
+
+    Before each notebook, the kernel's variables are deleted and it moves to
+    the notebook's folder. Modules that were imported stay imported, so
+    importing them again is quick.
+    """
+
+    def __init__(self, kernel_name, preload=()):
+        from nbclient import NotebookClient
+        from nbformat.v4 import new_notebook
+
+        client = NotebookClient(new_notebook(), kernel_name=kernel_name)
+        client.km = client.start_kernel_manager()
+        client.start_new_kernel_client()
+        self.km = client.km
+        self.kc = client.kc
+        self.n_notebooks = 0
+        if preload:
+            # Modules that can't be imported are left to the notebooks to report
+            self.run_code(
+                "".join(
+                    f"try:\n    import {module}\nexcept ImportError:\n    pass\n"
+                    for module in preload
+                )
+            )
+
+    def _client(self, nb, timeout=None):
+        from nbclient import NotebookClient
+
+        client = NotebookClient(nb, km=self.km, timeout=timeout, record_timing=False)
+        client.kc = self.kc
+        client.reset_execution_trackers()
+        return client
+
+    def run_code(self, code, timeout=None):
+        """Run code in the kernel, without recording it in its history.
+
+        It can run for `timeout` seconds, or forever if it's None.
+        """
+        from nbformat.v4 import new_code_cell, new_notebook
+
+        cell = new_code_cell(code)
+        self._client(new_notebook(cells=[cell]), timeout).execute_cell(
+            cell, 0, store_history=False
+        )
+
+    def reset(self, cwd, timeout=None):
+        """Delete the kernel's variables, and move it to the `cwd` folder."""
+        self.run_code(f"%reset -f\nimport os\nos.chdir({str(cwd)!r})\ndel os", timeout)
+
+    def execute(self, nb, cwd, timeout, checkpoints=None, usage=None):
+        """Execute a notebook in this kernel, as nbclient would in a new kernel.
+
+        If `checkpoints` is given, execution starts from the last checkpoint
+        before the first cell that changed (see `_execute_from_checkpoint`).
+        The resources that cells use are measured in `usage`.
+        """
+        usage = usage if usage is not None else ResourceUsage()
+        usage.watch(self.km)
+        self.reset(cwd, timeout)
+        self.n_notebooks += 1
+        client = self._client(nb, timeout)
+        if checkpoints is not None:
+            _execute_from_checkpoint(self, client, nb, cwd, usage=usage, **checkpoints)
+        else:
+            _execute_cells(client, nb, usage)
+        info_msg = client.wait_for_reply(self.kc.kernel_info())
+        if info_msg is not None:
+            nb.metadata["language_info"] = info_msg["content"]["language_info"]
+        return nb
+
+    def shutdown(self):
+        from nbclient.util import ensure_async, just_run
+
+        self.kc.stop_channels()
+        just_run(ensure_async(self.km.shutdown_kernel(now=True)))
+
+
+class SetupKernel(WarmKernel):
+    """A kernel that runs a book's setup script, and then executes a notebook.
+
+    This is used when kernels can't be forked from a template that has run the
+    setup script (see `ForkedKernel`), for example on Windows.
+    """
+
+    def __init__(self, kernel_name, path_setup, cwd, timeout=None):
+        super().__init__(kernel_name)
+        self.reset(cwd)
+        self.run_code(
+            f"with open({str(path_setup)!r}) as _jb_file:\n"
+            f"    exec(compile(_jb_file.read(), {str(path_setup)!r}, 'exec'))\n"
+            "del _jb_file",
+            timeout,
+        )
+
+    def reset(self, cwd, timeout=None):
+        """Move the kernel to the `cwd` folder, keeping the setup's variables."""
+        self.run_code(f"__import__('os').chdir({str(cwd)!r})", timeout)
+
+
+class _ForkedKernelManager:
+    """What nbclient needs of a kernel manager, for a kernel forked by a template.
+
+    The kernel is a child of the template process rather than of this one, so
+    it's only known by its process id.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def is_alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def interrupt_kernel(self):
+        os.kill(self.pid, signal.SIGINT)
+
+    def shutdown_kernel(self, now=False):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class ForkedKernel(SetupKernel):
+    """A kernel forked from a template process, which has run a setup script.
+
+    The kernel starts with the setup script's variables, and shares their
+    memory with the other kernels forked from the template until it changes
+    them (see `kernel_template.py`).
+    """
+
+    def __init__(self, path_socket, cwd):
+        import json
+        import socket
+        from uuid import uuid4
+        from jupyter_client.asynchronous import AsyncKernelClient
+        from jupyter_client.connect import write_connection_file
+        from nbclient.util import just_run
+
+        self.connection_file, _ = write_connection_file(key=uuid4().hex.encode())
+        request = {"connection_file": self.connection_file, "cwd": str(cwd)}
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(path_socket)
+            conn.sendall((json.dumps(request) + "\n").encode("utf8"))
+            reply = json.loads(conn.makefile().readline())
+        if "error" in reply:
+            os.remove(self.connection_file)
+            raise RuntimeError(f"The setup script failed:\n{reply['error']}")
+
+        self.km = _ForkedKernelManager(reply["pid"])
+        self.kc = AsyncKernelClient(connection_file=self.connection_file)
+        self.kc.load_connection_file()
+        self.kc.start_channels()
+        just_run(self.kc.wait_for_ready(timeout=60))
+        self.n_notebooks = 0
+
+    def shutdown(self):
+        super().shutdown()
+        os.remove(self.connection_file)
+
+
+@contextmanager
+def kernel_templates(kernel_names, path_setup, cwd, timeout=None, logger=LOGGER):
+    """Start a process for each kernel, which runs a setup script and forks kernels.
+
+    Yields the path of the unix socket that kernels are forked from, by kernel
+    name. Kernels that can't be forked aren't included, for example on Windows
+    or if the kernel's Python can't start a template. A template whose setup
+    script runs for longer than `timeout` seconds is stopped, and isn't
+    included either. If `timeout` is None or negative, the setup script can
+    run forever.
+    """
+    import subprocess
+    from jupyter_client.kernelspec import KernelSpecManager
+
+    templates = {}
+    if not kernel_names:
+        yield templates
+        return
+
+    processes = []
+    folder = tempfile.mkdtemp(prefix="jupyter-book-")
+    try:
+        if hasattr(os, "fork"):
+            script = Path(__file__).parent.joinpath("kernel_template.py")
+            for ii, kernel_name in enumerate(sorted(kernel_names)):
+                python = KernelSpecManager().get_kernel_spec(kernel_name).argv[0]
+                path_socket = os.path.join(folder, f"{ii}.sock")
+                cmd = [python, str(script), path_socket, str(path_setup)]
+                processes.append(
+                    subprocess.Popen(
+                        cmd,
+                        cwd=str(cwd),
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+                )
+                templates[kernel_name] = path_socket
+
+        # Wait for the setup script to run
+        deadline = None
+        if timeout is not None and timeout >= 0:
+            deadline = time.monotonic() + timeout
+        for process, (kernel_name, path_socket) in zip(
+            processes, list(templates.items())
+        ):
+            while not os.path.exists(path_socket):
+                if process.poll() is not None:
+                    del templates[kernel_name]
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    logger.warning(
+                        f"The setup script ran for longer than {timeout} seconds "
+                        f"in a template for {kernel_name}"
+                    )
+                    process.terminate()
+                    del templates[kernel_name]
+                    break
+                time.sleep(0.1)
+        for kernel_name in set(kernel_names) - set(templates):
+            logger.warning(
+                f"Kernels can't be forked for {kernel_name}, so the setup script "
+                "is run for each notebook"
+            )
+        yield templates
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+# The warm kernels of this process, by kernel name
+_WARM_KERNELS = {}
+
+
+def _execute_in_warm_kernel(
+    nb, cwd, timeout, preload=(), max_notebooks=10, checkpoints=None, usage=None
+):
+    """Execute a notebook in a warm kernel, starting one if there isn't one."""
+    from multiprocessing.util import Finalize
+
+    if not _WARM_KERNELS:
+        # Worker processes don't run `atexit` functions
+        Finalize(None, shutdown_warm_kernels, exitpriority=10)
+
+    kernel_name = nb.metadata["kernelspec"]["name"]
+    kernel = _WARM_KERNELS.get(kernel_name)
+    if kernel is not None and kernel.n_notebooks >= max_notebooks:
+        # Kernels are recycled, so notebooks can't affect each other too much
+        _WARM_KERNELS.pop(kernel_name).shutdown()
+        kernel = None
+    if kernel is None:
+        kernel = _WARM_KERNELS[kernel_name] = WarmKernel(kernel_name, preload)
+
+    try:
+        kernel.execute(nb, cwd, timeout, checkpoints, usage)
+    except Exception:
+        # The kernel may be dead or still busy, so the next notebook gets a new one
+        _WARM_KERNELS.pop(kernel_name)
+        try:
+            kernel.shutdown()
+        except Exception:
+            pass
+        raise
+
+
+def shutdown_warm_kernels():
+    """Shut down the warm kernels of this process."""
+    while _WARM_KERNELS:
+        _, kernel = _WARM_KERNELS.popitem()
+        kernel.shutdown()
+
+
+def kernel_pool_options(kernel_pool, preload, max_notebooks):
+    """Return the `kernel_pool` argument of `execute_notebooks` from the config."""
+    if not kernel_pool:
+        return None
+    return {"preload": list(preload or []), "max_notebooks": max(max_notebooks, 1)}
+
+
+# The kernel's variables, except IPython's own, are pickled with dill
+_SAVE_CHECKPOINT = """\
+import dill as _jb_dill
+with open({path!r}, "wb") as _jb_file:
+    _jb_dill.dump(
+        {{
+            _jb_name: _jb_value
+            for _jb_name, _jb_value in get_ipython().user_ns.items()
+            if not _jb_name.startswith("_")
+            and _jb_name not in get_ipython().user_ns_hidden
+        }},
+        _jb_file,
+    )
+del _jb_dill, _jb_file
+"""
+
+_LOAD_CHECKPOINT = """\
+import dill as _jb_dill
+with open({path!r}, "rb") as _jb_file:
+    get_ipython().user_ns.update(_jb_dill.load(_jb_file))
+del _jb_dill, _jb_file
+"""
+
+
+def checkpoint_options(checkpoints, min_seconds, kept=2):
+    """Return the `checkpoints` argument of `execute_notebooks` from the config."""
+    if not checkpoints:
+        return None
+    return {"min_seconds": max(min_seconds, 0), "kept": max(kept, 1)}
+
+
+def checkpoint_keys(nb, seed=None):
+    """Return a key for each code cell, from the code of the cells up to it.
+
+    A cell's key changes when its code or the code of a cell before it
+    changes, so a checkpoint that is saved after a cell is only restored when
+    the notebook is the same up to that cell. `seed` is hashed first, for
+    example the hash of the files that the notebook reads.
+    """
+    hashes = sha256((seed or "").encode("utf8"))
+    kernel_name = nb.metadata.get("kernelspec", {}).get("name", "")
+    hashes.update(kernel_name.encode("utf8"))
+    keys = []
+    for cell in nb.cells:
+        if cell.cell_type == "code":
+            hashes.update(sha256(cell.source.encode("utf8")).digest())
+            keys.append(hashes.hexdigest())
+    return keys
+
+
+def _execute_from_checkpoint(
+    kernel, client, nb, cwd, folder, seed=None, min_seconds=10, kept=2, usage=None
+):
+    """Execute a notebook's cells from the last checkpoint that is still valid.
+
+    After a code cell runs, its outputs are saved in `folder`, keyed by its
+    code and the code of the cells before it. Once cells have run for
+    `min_seconds` since the last checkpoint, the kernel's variables are saved
+    too. They're also saved after the last cell if the cells that ran took
+    `min_seconds` in total, so that cells appended to the notebook are the only
+    ones executed the next time. When the notebook is executed again, the
+    outputs of the cells before the last checkpoint that is still valid are
+    restored, along with the kernel's variables, and only the cells after it
+    are executed. If the checkpoint can't be restored, every cell is executed.
+    The resources that the cells that are executed use are measured in
+    `usage`.
+
+    Saving and restoring variables needs dill, in the kernel's environment.
+    Each checkpoint holds all of the kernel's variables, so only the last
+    `kept` checkpoints that are still valid are kept once the notebook is
+    executed, along with the outputs of its cells. Saving and restoring them
+    can take as long as a cell, the client's timeout.
+    """
+    import json
+    import nbformat
+
+    usage = usage if usage is not None else ResourceUsage()
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    cells = [
+        (index, cell) for index, cell in enumerate(nb.cells) if cell.cell_type == "code"
+    ]
+    keys = checkpoint_keys(nb, seed)
+
+    # The number of code cells before the last checkpoint that is still valid
+    n_saved = 0
+    while n_saved < len(keys) and folder.joinpath(f"{keys[n_saved]}.json").exists():
+        n_saved += 1
+    n_restored = next(
+        (
+            count
+            for count in range(n_saved, 0, -1)
+            if folder.joinpath(f"{keys[count - 1]}.pkl").exists()
+        ),
+        0,
+    )
+    if n_restored:
+        try:
+            path_state = folder.joinpath(f"{keys[n_restored - 1]}.pkl")
+            kernel.run_code(
+                _LOAD_CHECKPOINT.format(path=str(path_state)), client.timeout
+            )
+            for (_, cell), key in zip(cells[:n_restored], keys):
+                saved = json.loads(folder.joinpath(f"{key}.json").read_text())
+                cell.outputs = nbformat.from_dict(saved["outputs"])
+                cell.execution_count = saved["execution_count"]
+            client.code_cells_executed = n_restored
+        except Exception:
+            LOGGER.debug("Checkpoint can't be restored", exc_info=True)
+            kernel.reset(cwd, client.timeout)
+            n_restored = 0
+            for _, cell in cells:
+                cell.outputs = []
+
+    try:
+        can_save = True
+        seconds = 0.0
+        total = 0.0
+        for (index, cell), key in zip(cells[n_restored:], keys[n_restored:]):
+            start = time.perf_counter()
+            with usage.cell(index):
+                client.execute_cell(
+                    cell, index, execution_count=client.code_cells_executed + 1
+                )
+            seconds += time.perf_counter() - start
+            total += time.perf_counter() - start
+            saved = {"outputs": cell.outputs, "execution_count": cell.execution_count}
+            folder.joinpath(f"{key}.json").write_text(json.dumps(saved))
+            # The last cell is checkpointed unless the whole run was quick
+            last = key == keys[-1] and total >= min_seconds
+            if can_save and (seconds >= min_seconds or last):
+                path_state = folder.joinpath(f"{key}.pkl")
+                try:
+                    kernel.run_code(
+                        _SAVE_CHECKPOINT.format(path=str(path_state)), client.timeout
+                    )
+                    seconds = 0.0
+                except Exception:
+                    # For example, if dill isn't installed or a variable can't
+                    # be pickled
+                    LOGGER.debug("Checkpoint can't be saved", exc_info=True)
+                    if path_state.exists():
+                        path_state.unlink()
+                    can_save = False
+    finally:
+        states = [key for key in keys if folder.joinpath(f"{key}.pkl").exists()]
+        old_states = {f"{key}.pkl" for key in states[:-kept]}
+        keys = set(keys)
+        for path in folder.iterdir():
+            if path.stem not in keys or path.name in old_states:
+                path.unlink()
+
+
+def find_dependencies(path, nb, path_book, patterns=None):
+    """Return the files that a notebook reads, so it's executed when they change.
+
+    Parameters
+    ----------
+    path : str | Path
+        Path to the notebook.
+    nb : NotebookNode
+        The notebook. Its ``execution.dependencies`` metadata is a list of glob
+        patterns, relative to the notebook's folder.
+    path_book : str | Path
+        Path to the book's folder.
+    patterns : dict | None
+        Glob patterns of notebooks (relative to the book's folder), and the glob
+        patterns of the files (relative to the book's folder) that they read.
+
+    Returns
+    -------
+    paths : list
+        The absolute paths of the files, sorted.
+    """
+    path = Path(path).absolute()
+    path_book = Path(path_book).absolute()
+    path_rel = path.relative_to(path_book).as_posix()
+
+    files = set()
+    for pattern_nb, patterns_files in (patterns or {}).items():
+        if fnmatch(path_rel, pattern_nb):
+            for pattern in patterns_files:
+                files.update(path_book.glob(pattern))
+    for pattern in nb.metadata.get("execution", {}).get("dependencies", []):
+        files.update(path.parent.glob(pattern))
+    return sorted(file for file in files if file.is_file() and file != path)
+
+
+def find_all_dependencies(path, nb, path_book, patterns=None):
+    """Return the files that a notebook reads, and the files that they read.
+
+    Files that a notebook reads can be other notebooks, which have to be
+    executed before it. The files that those notebooks read are included too,
+    since the notebook has to be executed again when they change.
+    """
+    from .utils import SUPPORTED_FILE_SUFFIXES
+
+    path = Path(path).absolute()
+    files = set()
+    to_visit = find_dependencies(path, nb, path_book, patterns)
+    while to_visit:
+        file = to_visit.pop()
+        if file in files or file == path:
+            continue
+        files.add(file)
+        if file.suffix in SUPPORTED_FILE_SUFFIXES and is_notebook(file):
+            upstream = read_notebook(file)
+            to_visit.extend(find_dependencies(file, upstream, path_book, patterns))
+    return sorted(files)
+
+
+def hash_dependencies(paths, path_book):
+    """Return the hash of the contents of a notebook's dependencies, or None."""
+    if not paths:
+        return None
+    hashes = sha256()
+    for path in paths:
+        hashes.update(Path(path).relative_to(path_book).as_posix().encode("utf8"))
+        hashes.update(sha256(Path(path).read_bytes()).digest())
+    return hashes.hexdigest()
+
+
+def find_outputs(path, nb, path_book, patterns=None):
+    """Return the glob patterns of the files that a notebook writes.
+
+    As with `find_dependencies`, they're taken from the notebook's
+    ``execution.outputs`` metadata, where they're relative to the notebook's
+    folder, and from `patterns`, which maps glob patterns of notebooks to
+    patterns of the files that they write, both relative to the book's folder.
+
+    Returns
+    -------
+    outputs : list
+        The patterns, relative to the notebook's folder. Patterns of files
+        outside of the notebook's folder aren't included, since these files
+        aren't in its sandbox.
+    """
+    path_rel = Path(path).absolute().relative_to(Path(path_book).absolute())
+    folder_parts = path_rel.parent.parts
+    outputs = []
+    for pattern_nb, patterns_files in (patterns or {}).items():
+        if not fnmatch(path_rel.as_posix(), pattern_nb):
+            continue
+        for pattern in patterns_files:
+            parts = Path(pattern).parts
+            if len(parts) > len(folder_parts) and all(
+                fnmatch(folder, part) for folder, part in zip(folder_parts, parts)
+            ):
+                outputs.append(Path(*parts[len(folder_parts) :]).as_posix())
+    outputs.extend(nb.metadata.get("execution", {}).get("outputs", []))
+    return outputs
+
+
+# Sandboxes are hidden folders next to the notebook's folder
+SANDBOX_PREFIX = ".jupyter-book-sandbox-"
+
+
+@contextmanager
+def sandbox(folder, outputs, parent=None):
+    """Copy a notebook's folder to a temporary folder to execute it in.
+
+    The copy is made in `parent`, which defaults to the folder's parent, so
+    that relative paths to the files outside it still work. The files that
+    match the `outputs` patterns are copied back if no error is raised, and the
+    copy is then deleted.
+    """
+    folder = Path(folder)
+    parent = Path(parent) if parent is not None else folder.parent
+    try:
+        parent.mkdir(parents=True, exist_ok=True)
+        path_sandbox = tempfile.mkdtemp(prefix=SANDBOX_PREFIX, dir=parent)
+    except OSError:
+        # If the parent folder can't be written to, only relative paths inside
+        # the notebook's folder work
+        path_sandbox = tempfile.mkdtemp(prefix=SANDBOX_PREFIX)
+    path_sandbox = Path(path_sandbox)
+    try:
+        ignore = shutil.ignore_patterns(
+            "_build", ".git", ".ipynb_checkpoints", SANDBOX_PREFIX + "*"
+        )
+        # The sandbox already exists, so its contents are copied one by one
+        ignored = ignore(str(folder), [path.name for path in folder.iterdir()])
+        for path in folder.iterdir():
+            if path.name in ignored:
+                continue
+            if path.is_dir():
+                shutil.copytree(path, path_sandbox.joinpath(path.name), ignore=ignore)
+            else:
+                shutil.copy2(path, path_sandbox)
+        yield path_sandbox
+        for pattern in outputs:
+            for path_output in path_sandbox.glob(pattern):
+                if path_output.is_file():
+                    path_copy = folder.joinpath(path_output.relative_to(path_sandbox))
+                    path_copy.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(path_output, path_copy)
+    finally:
+        shutil.rmtree(path_sandbox, ignore_errors=True)
+
+
+def _execute_notebook(
+    path,
+    nb,
+    timeout,
+    kernel_pool=None,
+    outputs=None,
+    checkpoints=None,
+    setup=None,
+    sandbox_parent=None,
+):
+    """Execute a notebook in its folder. This runs in a worker process.
+
+    If `outputs` is a list of patterns, the notebook is executed in a copy of
+    its folder (made in `sandbox_parent`, see `sandbox`), and the files that
+    match them are copied back. If `checkpoints`
+    is given, execution starts from the last checkpoint that is still valid. If
+    `setup` is given, Python notebooks are executed in a kernel that has run a
+    setup script (see `_execute_in`).
+
+    Returns the executed notebook, how long it took, the traceback of the error
+    that stopped it (or None if it ran to the end), and the resources that its
+    cells used (see `ResourceUsage.summary`).
+    """
+    # Notebooks can set their own timeout, as with jupyter-cache's executor
+    timeout = nb.metadata.get("execution", {}).get("timeout", timeout)
+    usage = ResourceUsage()
+    start = time.perf_counter()
+    try:
+        if outputs is None:
+            _execute_in(
+                nb, Path(path).parent, timeout, kernel_pool, checkpoints, setup, usage
+            )
+        else:
+            with sandbox(Path(path).parent, outputs, sandbox_parent) as path_sandbox:
+                _execute_in(
+                    nb, path_sandbox, timeout, kernel_pool, checkpoints, setup, usage
+                )
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return nb, time.perf_counter() - start, error, usage.summary()
+
+
+def _execute_in(
+    nb, cwd, timeout, kernel_pool=None, checkpoints=None, setup=None, usage=None
+):
+    """Execute a notebook in the `cwd` folder, in a new kernel or a warm one.
+
+    If `setup` is given, the kernel is forked from the template at its
+    ``socket``, or runs the setup script at its ``path`` if there isn't one.
+    The resources that cells use are measured in `usage`.
+    """
+    # Resetting a kernel between notebooks, checkpoints and setup scripts need
+    # IPython
+    kernelspec = nb.metadata.get("kernelspec", {})
+    if kernelspec.get("language") != "python":
+        _execute_in_new_kernel(nb, cwd, timeout, usage)
+    elif setup is not None:
+        if setup["socket"] is not None:
+            kernel = ForkedKernel(setup["socket"], cwd)
+        else:
+            kernel = SetupKernel(
+                kernelspec["name"], setup["path"], setup["cwd"], timeout
+            )
+        try:
+            kernel.execute(nb, cwd, timeout, checkpoints, usage)
+        finally:
+            kernel.shutdown()
+    elif kernel_pool is not None:
+        _execute_in_warm_kernel(
+            nb, cwd, timeout, checkpoints=checkpoints, usage=usage, **kernel_pool
+        )
+    elif checkpoints is not None:
+        kernel = WarmKernel(kernelspec["name"])
+        try:
+            kernel.execute(nb, cwd, timeout, checkpoints, usage)
+        finally:
+            kernel.shutdown()
+    else:
+        _execute_in_new_kernel(nb, cwd, timeout, usage)
+
+
+def _execute_in_new_kernel(nb, cwd, timeout, usage=None):
+    """Execute a notebook in a new kernel, as `nbclient.execute` does."""
+    from nbclient import NotebookClient
+
+    usage = usage if usage is not None else ResourceUsage()
+    client = NotebookClient(nb, timeout=timeout, record_timing=False)
+    client.reset_execution_trackers()
+    with client.setup_kernel(cwd=str(cwd)):
+        usage.watch(client.km)
+        _execute_cells(client, nb, usage)
+        info_msg = client.wait_for_reply(client.kc.kernel_info())
+        if info_msg is not None:
+            nb.metadata["language_info"] = info_msg["content"]["language_info"]
+        client.set_widgets_metadata()
+
+
+def execute_notebooks(
+    paths,
+    path_cache,
+    workers=1,
+    timeout=30,
+    kernel_pool=None,
+    path_book=None,
+    dependencies=None,
+    sandbox=False,
+    outputs=None,
+    checkpoints=None,
+    kernel_setup=None,
+    stream=None,
+    build_cache=None,
+    found_dependencies=None,
+    finished=None,
+    logger=LOGGER,
+):
+    """Execute the notebooks that aren't in the cache, and cache their outputs.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the notebooks to execute.
+    path_cache : str | Path
+        Path to the jupyter cache.
+    workers : int
+        The number of notebooks that are executed at the same time.
+    timeout : int
+        The time (in seconds) that each cell can run for.
+    kernel_pool : dict | None
+        If given, Python notebooks are executed in kernels that are kept running
+        between notebooks. The modules of its ``preload`` list are imported when
+        each kernel starts, and kernels are restarted after ``max_notebooks``
+        notebooks. By default, each notebook is executed in a new kernel.
+    path_book : str | Path | None
+        Path to the book's folder. Needed for ``dependencies``.
+    dependencies : dict | None
+        Glob patterns of notebooks, and the glob patterns of the files they
+        read (see `find_dependencies`). Notebooks are executed again when the
+        files they read change, even if they're in the cache.
+    sandbox : bool
+        Whether to execute each notebook in a copy of its folder, so that
+        notebooks that are executed at the same time don't overwrite each
+        other's files.
+    outputs : dict | None
+        Glob patterns of notebooks, and the glob patterns of the files they
+        write, relative to ``path_book`` (see `find_outputs`). In a sandbox,
+        these files are copied back to the notebook's folder.
+    checkpoints : dict | None
+        If given, the variables of Python notebooks are saved in the cache
+        after cells that ran for ``min_seconds`` since the last checkpoint.
+        When a notebook changes, it's executed from the last checkpoint before
+        its first cell that changed (see `_execute_from_checkpoint`).
+    kernel_setup : str | Path | None
+        Path to a Python script that Python notebooks need, such as a script
+        that loads a large dataset. It's run once, in a process that kernels
+        are then forked from, so that they start with its variables. Where
+        kernels can't be forked, it's run in each notebook's kernel. It's run
+        in ``path_book``, can run for ``timeout`` seconds, like a cell, and
+        takes precedence over ``kernel_pool``.
+    stream : file | None
+        If it's a terminal, a status line with the notebooks that are running
+        and the time left is drawn on it. Otherwise, the status is logged every
+        `PROGRESS_INTERVAL` seconds.
+    build_cache : BuildCache | None
+        A cache shared between machines (see `jupyter_book.build_cache`).
+        Notebooks that aren't in the jupyter cache are fetched from it if they
+        were executed elsewhere, and the notebooks that are executed are
+        stored in it.
+    found_dependencies : dict | None
+        If given, the files that each notebook reads are added to it, by the
+        notebook's path, so that they don't have to be found again.
+    finished : callable | None
+        If given, it's called with the result of each notebook that is
+        executed, as soon as it's finished.
+    logger : logging.Logger
+        The logger that progress is reported to.
+
+    Returns
+    -------
+    results : list
+        A dictionary for each notebook, with its ``path``, its ``status``
+        ("cached", "succeeded" or "failed"), the ``seconds`` it took to execute,
+        and the ``traceback`` of its error, if it failed. Its kernel's
+        ``cpu_seconds`` and ``peak_rss`` (in bytes) are included too if psutil
+        is installed, along with the same values for each of its ``cells``.
+    """
+    from jupyter_cache import get_cache
+    from .build_cache import fetch_notebook, notebook_key, store_notebook
+
+    cache = get_cache(str(path_cache))
+
+    results = []
+    to_execute = []
+    # The hash of the files that each notebook reads, which is kept with its outputs
+    digests = {}
+    # The files that each notebook reads, which include the notebooks it needs
+    upstream = {}
+    # The files that each notebook writes, if it's executed in a sandbox
+    sandbox_outputs = {}
+    # Where the sandboxes of notebooks that aren't next to their folder go
+    sandbox_parents = {}
+    # The key of each notebook in the build cache
+    keys = {}
+    for path in paths:
+        path = str(Path(path).absolute())
+        nb = read_notebook(path)
+        if path_book is not None:
+            files = find_all_dependencies(path, nb, path_book, dependencies)
+            digests[path] = hash_dependencies(files, Path(path_book).absolute())
+            upstream[path] = {str(file) for file in files}
+            if found_dependencies is not None:
+                found_dependencies[path] = files
+        if sandbox:
+            path_book_nb = path_book if path_book is not None else Path(path).parent
+            sandbox_outputs[path] = find_outputs(path, nb, path_book_nb, outputs)
+            # A sandbox next to the book's folder would be outside of the book
+            path_book_nb = Path(path_book_nb).absolute()
+            if path_book is not None and Path(path).parent == path_book_nb:
+                sandbox_parents[path] = path_book_nb.joinpath("_build")
+        try:
+            record = cache.match_cache_notebook(nb)
+        except KeyError:
+            record = None
+        if (
+            record is not None
+            and (record.data or {}).get("dependencies") == digests.get(path)
+        ):
+            results.append(_result(path, "cached"))
+            continue
+
+        if build_cache is not None:
+            keys[path] = notebook_key(path, nb, path_book, digests.get(path))
+            fetched = fetch_notebook(build_cache, keys[path])
+            if fetched is not None:
+                _store_in_cache(cache, path, *fetched, digests.get(path))
+                logger.info(f"Fetched from the build cache: {path}")
+                results.append(_result(path, "cached", fetched[1]))
+                continue
+        to_execute.append((path, nb))
+    if not to_execute:
+        return results
+    at_root = [path for path, _ in to_execute if path in sandbox_parents]
+    if at_root:
+        logger.warning(
+            "The whole book is copied to execute each notebook at its root in a "
+            f"sandbox ({len(at_root)} notebooks). To copy less, move them to a "
+            "folder"
+        )
+
+    # Notebooks wait for the notebooks they need that are executed too
+    notebooks = dict(to_execute)
+    upstream = {
+        path: upstream.get(path, set()).intersection(notebooks) for path in notebooks
+    }
+    durations = _past_durations(cache)
+    order, makespan = schedule_notebooks(list(notebooks), durations, workers, upstream)
+
+    logger.info(
+        f"Executing {len(to_execute)} notebooks ({len(results)} are cached) "
+        f"with {workers} workers"
+    )
+    _log_without_psutil(logger)
+    # Python kernels are forked from a template that has run the setup script
+    kernel_names = set()
+    path_setup_cwd = path_book if path_book is not None else os.getcwd()
+    if kernel_setup is not None:
+        kernel_setup = Path(kernel_setup).absolute()
+        kernel_names = {
+            nb.metadata["kernelspec"]["name"]
+            for nb in notebooks.values()
+            if nb.metadata.get("kernelspec", {}).get("language") == "python"
+        }
+
+    start = time.perf_counter()
+    try:
+        with kernel_templates(
+            kernel_names, kernel_setup, path_setup_cwd, timeout, logger
+        ) as templates, ExecutionProgress(
+            order, durations, upstream, workers, path_book, stream, logger=logger
+        ) as progress:
+            for path, executed in _execute_in_order(
+                order,
+                upstream,
+                lambda path: (
+                    path,
+                    notebooks[path],
+                    timeout,
+                    kernel_pool,
+                    sandbox_outputs.get(path),
+                    _checkpoint_arguments(path_cache, path, checkpoints, digests),
+                    _setup_arguments(
+                        kernel_setup, path_setup_cwd, notebooks[path], templates
+                    ),
+                    sandbox_parents.get(path),
+                ),
+                workers,
+                progress.start,
+            ):
+                progress.finish(path, executed[1])
+                with progress.hidden():
+                    result = _cache_result(
+                        cache, path, *executed, logger, digests.get(path)
+                    )
+                    if build_cache is not None and result["status"] == "succeeded":
+                        store_notebook(build_cache, keys[path], *executed[:2])
+                    results.append(result)
+                if finished is not None:
+                    finished(result)
+    finally:
+        # Kernels that were kept running in this process
+        shutdown_warm_kernels()
+
+    message = (
+        f"Executed {len(to_execute)} notebooks in {time.perf_counter() - start:.1f}s"
+    )
+    if makespan is not None:
+        message += f" (predicted from past executions: {makespan:.1f}s)"
+    logger.info(message)
+    return results
+
+
+def _setup_arguments(path_setup, cwd, nb, templates):
+    """Return the `setup` argument of `_execute_notebook` for a notebook."""
+    if path_setup is None:
+        return None
+    kernel_name = nb.metadata.get("kernelspec", {}).get("name")
+    return {
+        "path": str(path_setup),
+        "cwd": str(cwd),
+        "socket": templates.get(kernel_name),
+    }
+
+
+def _checkpoint_arguments(path_cache, path, checkpoints, digests):
+    """Return the `checkpoints` argument of `_execute_notebook` for a notebook."""
+    if checkpoints is None:
+        return None
+    name = sha256(str(path).encode("utf8")).hexdigest()[:16]
+    return dict(
+        checkpoints,
+        folder=str(Path(path_cache, "checkpoints", name)),
+        # Checkpoints aren't valid once the files the notebook reads change
+        seed=digests.get(path),
+    )
+
+
+def _execute_in_order(order, upstream, arguments, workers, started=None):
+    """Execute notebooks once the notebooks they need have been executed.
+
+    Notebooks are started in `order` as soon as the notebooks they need have
+    been executed, `workers` at a time. Notebooks that need a notebook that
+    failed aren't executed. `started` is called with the path of each notebook
+    when it starts.
+
+    Yields the path of each notebook, and what `_execute_notebook` returned for
+    it, as they're executed.
+    """
+    pending = list(order)
+    finished = set()
+    failed = set()
+    running = {}
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        while pending or running:
+            path = None
+            if len(running) < workers:
+                path = next(
+                    (
+                        path
+                        for path in pending
+                        if upstream[path] & failed or upstream[path] <= finished
+                    ),
+                    None,
+                )
+
+            if path is not None:
+                pending.remove(path)
+                if upstream[path] & failed:
+                    needed = ", ".join(sorted(upstream[path] & failed))
+                    error = f"Not executed, since a notebook it needs failed: {needed}"
+                    executed = (None, None, error, None)
+                elif pool is not None:
+                    future = pool.submit(_execute_notebook, *arguments(path))
+                    running[future] = path
+                    if started is not None:
+                        started(path)
+                    continue
+                else:
+                    if started is not None:
+                        started(path)
+                    executed = _execute_notebook(*arguments(path))
+            elif running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                path = running.pop(future)
+                try:
+                    executed = future.result()
+                except Exception:
+                    # The worker process itself failed
+                    executed = (None, None, traceback.format_exc(), None)
+            else:
+                # The notebooks that are left need each other
+                path = pending.pop(0)
+                executed = (
+                    None,
+                    None,
+                    "Not executed, since the notebooks it needs need it",
+                    None,
+                )
+
+            (failed if executed[2] is not None else finished).add(path)
+            yield path, executed
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def _past_durations(cache):
+    """Return how long each notebook took to execute the last time it was cached."""
+    durations = {}
+    for record in sorted(cache.list_cache_records(), key=lambda record: record.created):
+        seconds = (record.data or {}).get("execution_seconds")
+        if seconds is not None:
+            durations[record.uri] = seconds
+    return durations
+
+
+def schedule_notebooks(paths, durations, workers, upstream=None):
+    """Order notebooks from longest to shortest, and predict how long they'll take.
+
+    Each notebook is predicted to take as long as it took in the past, or the
+    average of every notebook that was executed before if it never was.
+    The longest notebooks are started first, so that a long notebook that's
+    started last doesn't hold up the whole execution. A notebook that other
+    notebooks need counts as long as the longest chain of notebooks after it.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the notebooks to execute.
+    durations : dict
+        How long (in seconds) notebooks took to execute, by path.
+    workers : int
+        The number of notebooks that are executed at the same time.
+    upstream : dict | None
+        The paths of the notebooks in `paths` that each notebook needs.
+
+    Returns
+    -------
+    paths : list
+        The paths, in the order their notebooks should be started.
+    makespan : float | None
+        The predicted time to execute every notebook, or None if no notebook
+        has been executed before.
+    """
+    if not any(str(path) in durations for path in paths):
+        return list(paths), None
+
+    average = sum(durations.values()) / len(durations)
+    predicted = {path: durations.get(str(path), average) for path in paths}
+    upstream = upstream or {}
+    downstream = {path: [] for path in paths}
+    for path in paths:
+        for needed in upstream.get(path, ()):
+            downstream[needed].append(path)
+
+    # How long it takes to execute a notebook, and the notebooks after it
+    chains = {}
+
+    def chain(path, visiting=()):
+        if path not in chains:
+            after = [
+                chain(other, visiting + (path,))
+                for other in downstream[path]
+                if other not in visiting
+            ]
+            chains[path] = predicted[path] + max(after, default=0)
+        return chains[path]
+
+    order = sorted(paths, key=chain, reverse=True)
+    return order, _predict_makespan(order, predicted, upstream, workers)
+
+
+def _predict_makespan(order, predicted, upstream, workers):
+    """Simulate executing notebooks as `_execute_in_order` does."""
+    pending = list(order)
+    finished = set()
+    running = []
+    now = 0.0
+    while pending or running:
+        for path in [path for path in pending if upstream.get(path, set()) <= finished]:
+            if len(running) >= max(workers, 1):
+                break
+            pending.remove(path)
+            heapq.heappush(running, (now + predicted[path], path))
+        if not running:
+            # The notebooks that are left need each other
+            break
+        now, path = heapq.heappop(running)
+        finished.add(path)
+    return now
+
+
+def _format_seconds(seconds):
+    """Return a duration as hours, minutes and seconds, e.g. ``1h 02m``."""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class ExecutionProgress:
+    """Show which notebooks are running, and how long the rest will take.
+
+    On a terminal, a status line is redrawn every second. Otherwise (for
+    example, in CI logs), it's logged every `interval` seconds. How long the
+    rest will take is predicted as `schedule_notebooks` does, from how long
+    notebooks took in the past, and how long the notebooks that were executed
+    so far took.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the notebooks to execute, in the order they're started.
+    durations : dict
+        How long (in seconds) notebooks took to execute in the past, by path.
+    upstream : dict
+        The paths of the notebooks in `paths` that each notebook needs.
+    workers : int
+        The number of notebooks that are executed at the same time.
+    path_book : str | Path | None
+        Notebooks are shown relative to this folder.
+    stream : file | None
+        The status line is drawn on this stream, if it's a terminal.
+    interval : float
+        How often (in seconds) progress is logged, if `stream` isn't a terminal.
+    logger : logging.Logger
+        The logger that progress is reported to.
+    """
+
+    def __init__(
+        self,
+        paths,
+        durations,
+        upstream,
+        workers,
+        path_book=None,
+        stream=None,
+        interval=PROGRESS_INTERVAL,
+        logger=LOGGER,
+    ):
+        self.pending = [str(path) for path in paths]
+        self.durations = durations
+        self.upstream = upstream
+        self.workers = workers
+        self.path_book = path_book
+        self.stream = stream
+        self.tty = stream is not None and getattr(stream, "isatty", lambda: False)()
+        self.interval = 1 if self.tty else interval
+        self.logger = logger
+        self.running = {}
+        self.finished = {}
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._report, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self._clear()
+
+    def start(self, path, now=None):
+        """Record that a notebook started to execute."""
+        with self.lock:
+            self.pending.remove(path)
+            self.running[path] = time.perf_counter() if now is None else now
+
+    def finish(self, path, seconds):
+        """Record that a notebook was executed (or wasn't, if `seconds` is None)."""
+        with self.lock:
+            if path in self.pending:
+                # Notebooks that aren't executed aren't started
+                self.pending.remove(path)
+            self.running.pop(path, None)
+            self.finished[path] = seconds
+
+    def eta(self, now=None):
+        """Return how long executing the rest of the notebooks should take."""
+        now = time.perf_counter() if now is None else now
+        with self.lock:
+            known = dict(self.durations)
+            known.update(
+                {path: secs for path, secs in self.finished.items() if secs is not None}
+            )
+            if not known:
+                return None
+            average = sum(known.values()) / len(known)
+            predicted = {
+                path: max(known.get(path, average) - (now - start), 0)
+                for path, start in self.running.items()
+            }
+            predicted.update({path: known.get(path, average) for path in self.pending})
+            upstream = {
+                path: set(self.upstream.get(path, ())).intersection(predicted)
+                for path in predicted
+            }
+            order = list(self.running) + self.pending
+        return _predict_makespan(order, predicted, upstream, self.workers)
+
+    def status(self, now=None):
+        """Return a line with the notebooks that are running, and the ETA."""
+        now = time.perf_counter() if now is None else now
+        with self.lock:
+            total = len(self.pending) + len(self.running) + len(self.finished)
+            running = ", ".join(
+                f"{self._name(path)} ({_format_seconds(now - start)})"
+                for path, start in self.running.items()
+            )
+            line = f"{len(self.finished)}/{total} notebooks executed"
+            if running:
+                line += f", running: {running}"
+            eta = self.eta(now)
+            if eta is not None:
+                line += f", about {_format_seconds(eta)} left"
+        return line
+
+    @contextmanager
+    def hidden(self):
+        """Hide the status line while messages are logged."""
+        with self.lock:
+            self._clear()
+            yield
+
+    def _name(self, path):
+        if self.path_book is None:
+            return Path(path).name
+        return os.path.relpath(path, self.path_book)
+
+    def _clear(self):
+        if self.tty:
+            self.stream.write("\r\033[K")
+            self.stream.flush()
+
+    def _report(self):
+        while not self.stopped.wait(self.interval):
+            line = self.status()
+            with self.lock:
+                if self.tty:
+                    # Lines longer than the terminal would wrap, and not be
+                    # redrawn in place
+                    width = shutil.get_terminal_size().columns - 1
+                    self._clear()
+                    self.stream.write(line[:width])
+                    self.stream.flush()
+                else:
+                    self.logger.info(line)
+
+
+def _result(path, status, seconds=None, error=None, usage=None):
+    usage = usage or {"cpu_seconds": None, "peak_rss": None, "cells": []}
+    return {
+        "path": str(path),
+        "status": status,
+        "seconds": seconds,
+        "traceback": error,
+        **usage,
+    }
+
+
+def _cache_result(cache, path, nb, seconds, error, usage, logger, dependencies=None):
+    """Store an executed notebook in the cache, or the error that stopped it."""
+    from jupyter_cache.cache.db import NbStageRecord
+
+    if error is not None:
+        # MyST-NB reports the error of notebooks that are staged with a traceback
+        logger.error(f"Execution failed: {path}")
+        cache.stage_notebook_file(path)
+        NbStageRecord.set_traceback(str(Path(path).absolute()), error, cache.db)
+        return _result(path, "failed", seconds, error, usage)
+
+    _store_in_cache(cache, path, nb, seconds, dependencies)
+    logger.info(f"Executed ({seconds:.1f}s): {path}")
+    return _result(path, "succeeded", seconds, usage=usage)
+
+
+def _store_in_cache(cache, path, nb, seconds, dependencies=None):
+    """Store an executed notebook in the cache, with how long it took."""
+    from jupyter_cache.cache.main import NbBundleIn
+
+    data = {"execution_seconds": seconds, "dependencies": dependencies}
+    bundle = NbBundleIn(nb, path, data=data)
+    cache.cache_notebook_bundle(bundle, check_validity=False, overwrite=True)
+
+
+def write_execution_report(path_report, results, path_book, cells=False, logger=LOGGER):
+    """Write how long notebooks took to execute, and log the slowest notebooks.
+
+    Parameters
+    ----------
+    path_report : str | Path
+        Path to the JSON report.
+    results : list
+        What `execute_notebooks` returned.
+    path_book : str | Path
+        Path to the book's folder. Paths in the report are relative to it.
+    cells : bool
+        Whether to include the time and resources that each cell used.
+    logger : logging.Logger
+        The logger that the table of the slowest notebooks is written to.
+    """
+    import json
+
+    notebooks = []
+    for result in results:
+        notebook = dict(result, path=os.path.relpath(result["path"], path_book))
+        if not cells:
+            del notebook["cells"]
+        notebooks.append(notebook)
+    notebooks.sort(key=lambda notebook: notebook["seconds"] or 0, reverse=True)
+    path_report = Path(path_report)
+    path_report.parent.mkdir(parents=True, exist_ok=True)
+    path_report.write_text(json.dumps({"notebooks": notebooks}, indent=2))
+
+    def column(value, scale=1):
+        return f"{'':>12}" if value is None else f"{value / scale:>12.1f}"
+
+    executed = [notebook for notebook in notebooks if notebook["status"] != "cached"]
+    width = max([len("notebook")] + [len(nb["path"]) for nb in executed])
+    header = f"{'notebook':<{width}}{'seconds':>12}{'cpu seconds':>12}{'memory MB':>12}"
+    logger.info("")
+    logger.info(f"slowest notebooks ({N_SLOWEST} at most):")
+    logger.info(header)
+    for notebook in executed[:N_SLOWEST]:
+        logger.info(
+            f"{notebook['path']:<{width}}{column(notebook['seconds'])}"
+            f"{column(notebook['cpu_seconds'])}{column(notebook['peak_rss'], 1e6)}"
+        )
+    logger.info(f"The execution report was saved in {path_report}")
+
+
+def execute_book_notebooks(app):
+    """Execute the notebooks of the pages that will be read, before they're read.
+
+    This is connected to `builder-inited`, which happens before MyST-NB executes
+    notebooks on `env-get-outdated`. MyST-NB then finds every notebook in the
+    cache, and only inserts their outputs. If the build is profiled, the time
+    each notebook took is recorded under its page.
+    """
+    from sphinx.util import logging as sphinx_logging
+    from .build_cache import open_build_cache
+    from .manifest import find_unchanged_docs
+    from .profiling import span
+
+    logger = sphinx_logging.getLogger(__name__)
+    workers = app.config["execution_workers"]
+    # The files that each notebook reads, which `note_dependencies` reuses
+    app.jupyter_book_dependencies = {}
+    if app.config["jupyter_execute_notebooks"] != "cache":
+        if workers > 1:
+            logger.warning(
+                "execute.workers is only used when execute.execute_notebooks is "
+                "'cache'"
+            )
+        return
+
+    from myst_nb.cache import is_valid_exec_file
+
+    env = app.env
+    env.find_files(app.config, app.builder)
+    docnames = [
+        docname
+        for docname in sorted(env.found_docs)
+        if is_valid_exec_file(env, docname) and is_notebook(env.doc2path(docname))
+    ]
+    # Notebooks of pages that won't be read again aren't executed either
+    unchanged = set(find_unchanged_docs(app, env, docnames))
+    paths = [env.doc2path(docname) for docname in docnames if docname not in unchanged]
+    if not paths:
+        return
+
+    # The same default as MyST-NB
+    path_cache = app.config["jupyter_cache"] or Path(app.outdir).parent.joinpath(
+        ".jupyter_cache"
+    )
+    kernel_setup = app.config["execution_kernel_setup"]
+    if kernel_setup:
+        kernel_setup = Path(app.srcdir, kernel_setup)
+    else:
+        kernel_setup = None
+    profiler = getattr(app, "jupyter_book_profiler", None)
+
+    def finished(result):
+        if profiler is not None and result["seconds"] is not None:
+            end = time.time()
+            docname = env.path2doc(result["path"])
+            profiler.record("execute", docname, end - result["seconds"], end)
+
+    with span(app, "execute_notebooks"):
+        results = execute_notebooks(
+            paths,
+            path_cache,
+            workers=workers,
+            timeout=app.config["execution_timeout"],
+            kernel_pool=kernel_pool_options(
+                app.config["execution_kernel_pool"],
+                app.config["execution_kernel_preload"],
+                app.config["execution_kernel_max_notebooks"],
+            ),
+            path_book=app.srcdir,
+            dependencies=app.config["execution_dependencies"],
+            sandbox=app.config["execution_sandbox"],
+            outputs=app.config["execution_outputs"],
+            checkpoints=checkpoint_options(
+                app.config["execution_checkpoints"],
+                app.config["execution_checkpoint_seconds"],
+                app.config["execution_checkpoints_kept"],
+            ),
+            kernel_setup=kernel_setup,
+            stream=None if app.quiet else sys.stdout,
+            build_cache=(
+                open_build_cache(app.config["build_cache_url"])
+                if app.config["build_cache_url"]
+                else None
+            ),
+            found_dependencies=app.jupyter_book_dependencies,
+            finished=finished,
+            logger=logger,
+        )
+    if any(result["status"] != "cached" for result in results):
+        write_execution_report(
+            Path(app.outdir).parent.joinpath("reports", "execution.json"),
+            results,
+            app.srcdir,
+            cells=app.config["execution_report_cells"],
+            logger=logger,
+        )
+
+
+def note_dependencies(app, docname, source):
+    """Make the files that a notebook reads dependencies of its page.
+
+    Its page is then read again when they change. This is connected to
+    `source-read`. The files were found before the notebooks were executed,
+    if they were executed by `execute_book_notebooks`, and are only found here
+    for the other notebooks.
+    """
+    patterns = app.config["execution_dependencies"]
+    if not patterns and app.config["jupyter_execute_notebooks"] != "cache":
+        return
+    env = app.env
+    path = env.doc2path(docname)
+    if not is_notebook(path):
+        return
+    found = getattr(app, "jupyter_book_dependencies", {})
+    files = found.get(str(Path(path).absolute()))
+    if files is None:
+        from myst_nb.converter import string_to_notebook
+
+        nb = string_to_notebook(source[0], env, add_source_map=False)
+        if nb is None:
+            return
+        files = find_all_dependencies(path, nb, app.srcdir, patterns)
+    for file in files:
+        env.note_dependency(os.path.relpath(file, app.srcdir))
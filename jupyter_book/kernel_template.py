@@ -0,0 +1,83 @@
+"""Fork kernels from a process that has run a book's setup script.
+
+This script is run by `jupyter_book.execute`, with the Python of the notebooks'
+kernel, as::
+
+    python kernel_template.py PATH_SOCKET PATH_SETUP
+
+It runs the setup script once, and then listens on the unix socket
+`PATH_SOCKET`. For each connection, it reads the connection file of a kernel and
+the folder to start it in, forks, and starts an IPython kernel in the child
+process with the variables of the setup script. The child shares the memory of
+the setup script with the other kernels, until it changes it.
+
+This file is run as a script rather than imported, so that it works in a
+kernel's environment where jupyter-book isn't installed.
+"""
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+
+
+def run_setup(path_setup):
+    """Run the setup script, and return its variables and the error it raised."""
+    namespace = {"__name__": "__main__", "__file__": path_setup}
+    try:
+        with open(path_setup) as ff:
+            code = compile(ff.read(), path_setup, "exec")
+        exec(code, namespace)
+    except BaseException:
+        return namespace, traceback.format_exc()
+    return namespace, None
+
+
+def start_kernel(connection_file, cwd, namespace):
+    """Start an IPython kernel in this process, with the variables of `namespace`."""
+    from ipykernel.kernelapp import IPKernelApp
+
+    os.chdir(cwd)
+    app = IPKernelApp.instance(connection_file=connection_file, user_ns=namespace)
+    app.initialize([])
+    app.start()
+
+
+def main(path_socket, path_setup):
+    namespace, error = run_setup(path_setup)
+    # Imported before forking, so that kernels start quickly
+    import ipykernel.kernelapp  # noqa: F401
+
+    # Kernels are reaped as soon as they exit, so they don't become zombies
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The socket is only at `path_socket` once the setup script has run and
+    # kernels can be requested
+    server.bind(path_socket + ".tmp")
+    server.listen()
+    os.rename(path_socket + ".tmp", path_socket)
+    while True:
+        conn, _ = server.accept()
+        with conn:
+            request = json.loads(conn.makefile().readline())
+            if error is not None:
+                reply = {"error": error}
+            else:
+                pid = os.fork()
+                if pid == 0:
+                    server.close()
+                    conn.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    try:
+                        start_kernel(
+                            request["connection_file"], request["cwd"], namespace
+                        )
+                    finally:
+                        os._exit(0)
+                reply = {"pid": pid}
+            conn.sendall((json.dumps(reply) + "\n").encode("utf8"))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
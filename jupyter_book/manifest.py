@@ -0,0 +1,177 @@
+"""A small sphinx extension to decide which pages to re-read from their content.
+
+Sphinx re-reads a page when its source file (or a file it depends on) is newer
+than the last build, so a fresh checkout of a book re-reads every page even when
+nothing changed. Instead, we keep a manifest in the build folder with a hash of
+each page's source, its dependencies, its entry in the TOC and the configuration
+that affects it, and only re-read pages whose hash changed.
+"""
+import json
+import time
+from hashlib import sha256
+from pathlib import Path
+
+from sphinx.environment import CONFIG_OK, CONFIG_CHANGED
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Configuration values that only affect notebooks
+NOTEBOOK_CONFIG_PREFIXES = ("jupyter_execute", "jupyter_cache", "execution_")
+
+
+def _hash_file(path):
+    """Return the hash of a file's contents, or None if it doesn't exist."""
+    try:
+        return sha256(Path(path).read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def _hash_config(config, notebook):
+    """Return the hash of the configuration values that affect reading a page."""
+    values = {}
+    for item in config.filter("env"):
+        if not notebook and item.name.startswith(NOTEBOOK_CONFIG_PREFIXES):
+            continue
+        values[item.name] = item.value
+    text = json.dumps(values, sort_keys=True, default=repr)
+    return sha256(text.encode("utf8")).hexdigest()
+
+
+def _hash_doc(app, env, docname, config_hashes):
+    """Return the hash of everything that affects how a page is read."""
+    path_doc = Path(env.doc2path(docname))
+    notebook = path_doc.suffix == ".ipynb"
+    if notebook not in config_hashes:
+        config_hashes[notebook] = _hash_config(app.config, notebook)
+
+    toc_index = app.config["globaltoc_index"] if app.config["globaltoc_path"] else {}
+    toc_entry = toc_index.get(docname, {}).get("toctrees")
+    dependencies = {
+        str(dep): _hash_file(Path(env.srcdir, dep))
+        for dep in sorted(env.dependencies.get(docname, []))
+    }
+    content = {
+        "source": _hash_file(path_doc),
+        "toc": toc_entry,
+        "dependencies": dependencies,
+        "config": config_hashes[notebook],
+    }
+    text = json.dumps(content, sort_keys=True, default=repr)
+    return sha256(text.encode("utf8")).hexdigest()
+
+
+def _path_manifest(app):
+    return Path(app.doctreedir).joinpath(MANIFEST_NAME)
+
+
+def _load_manifest(app):
+    """Return the page hashes saved by the last build, if there are any."""
+    path_manifest = _path_manifest(app)
+    if not path_manifest.exists():
+        return {}
+    try:
+        manifest = json.loads(path_manifest.read_text())
+    except ValueError:
+        logger.warning(f"Ignoring a build manifest that can't be read: {path_manifest}")
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("docs", {})
+
+
+def _can_skip(env, docname):
+    """Return whether a page can keep what was read from it in the last build."""
+    # If the environment wasn't loaded from the last build, every page is read
+    if env.config_status not in (CONFIG_OK, CONFIG_CHANGED):
+        return False
+    if docname not in env.all_docs or docname in env.reread_always:
+        return False
+    return Path(env.doctreedir, docname + ".doctree").is_file()
+
+
+def find_unchanged_docs(app, env, docnames):
+    """Return the pages that won't be read again, since their hash didn't change."""
+    manifest = _load_manifest(app)
+    config_hashes = {}
+    return [
+        docname
+        for docname in docnames
+        if docname in manifest
+        and _can_skip(env, docname)
+        and manifest[docname] == _hash_doc(app, env, docname, config_hashes)
+    ]
+
+
+def find_changed_docs(app, env, added, changed, removed):
+    """Return the pages whose hash changed, even if their files weren't modified.
+
+    For example, a page whose sections changed in the TOC has to be read again.
+    """
+    # Some versions of Sphinx pass the builder instead of the environment
+    env = app.env
+    # Kept on the app rather than the environment, which Sphinx pickles
+    app.jupyter_book_manifest = _load_manifest(app)
+    app.jupyter_book_hashes = {}
+    config_hashes = {}
+    outdated = []
+    for docname in sorted(env.found_docs - added - changed):
+        if not _can_skip(env, docname):
+            continue
+        doc_hash = _hash_doc(app, env, docname, config_hashes)
+        app.jupyter_book_hashes[docname] = doc_hash
+        if app.jupyter_book_manifest.get(docname) != doc_hash:
+            outdated.append(docname)
+    return outdated
+
+
+def skip_unchanged_docs(app, env, docnames):
+    """Remove the pages whose hash hasn't changed from the pages to read."""
+    config_hashes = {}
+    skipped = []
+    for docname in docnames:
+        if docname not in app.jupyter_book_manifest or not _can_skip(env, docname):
+            continue
+        doc_hash = app.jupyter_book_hashes.get(docname)
+        if doc_hash is None:
+            doc_hash = _hash_doc(app, env, docname, config_hashes)
+            app.jupyter_book_hashes[docname] = doc_hash
+        if app.jupyter_book_manifest[docname] == doc_hash:
+            skipped.append(docname)
+
+    for docname in skipped:
+        docnames.remove(docname)
+        # So that Sphinx doesn't consider the page modified in the next build
+        env.all_docs[docname] = time.time()
+    if skipped:
+        logger.info(f"{len(skipped)} unchanged pages will not be read again")
+
+    # Pages that are read may have new dependencies, so their hash is updated
+    # once they're read
+    for docname in docnames:
+        app.jupyter_book_hashes.pop(docname, None)
+
+
+def save_manifest(app, env):
+    """Save the hash of each page after the pages are read."""
+    config_hashes = {}
+    hashes = {}
+    for docname in sorted(env.all_docs):
+        if docname not in env.found_docs:
+            # A page outside of the build's scope, which wasn't read again
+            if docname in app.jupyter_book_manifest:
+                hashes[docname] = app.jupyter_book_manifest[docname]
+            continue
+        if docname in app.jupyter_book_hashes:
+            hashes[docname] = app.jupyter_book_hashes[docname]
+        else:
+            hashes[docname] = _hash_doc(app, env, docname, config_hashes)
+
+    path_manifest = _path_manifest(app)
+    path_manifest.parent.mkdir(parents=True, exist_ok=True)
+    manifest = {"version": MANIFEST_VERSION, "docs": hashes}
+    path_manifest.write_text(json.dumps(manifest, indent=2, sort_keys=True))
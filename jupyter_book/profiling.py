@@ -0,0 +1,389 @@
+"""A small sphinx extension to record how long each page takes to build.
+
+When `profile_path` is set (`jb build --profile`), the time spent in each phase
+of the build is recorded for each page, and a report is written to
+`profile_path` at the end of each build, along with a table of the slowest pages.
+When `trace_path` is set (`jb build --trace`), the phases of the build are
+written to `trace_path` as Chrome trace events, one row per process.
+
+Reading a page includes parsing it and applying transforms to it. Parsing a
+notebook includes loading its outputs from the cache (or executing it, if it
+isn't cached), and transforms include adding the page's toctrees. Resolving and
+writing a page are timed separately. Notebooks that are executed together before
+pages are read are recorded in the `execute` phase of their page, and the whole
+execution in the `execute_notebooks` phase.
+"""
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+
+from sphinx.transforms import SphinxTransform
+from sphinx.util import logging
+from sphinx.util.console import bold
+
+logger = logging.getLogger(__name__)
+
+# The phases that are timed for each page
+PHASES = ["read", "parse", "execute", "transforms", "add_toctree", "resolve", "write"]
+# The number of pages in the table of the slowest pages
+N_SLOWEST = 20
+
+
+class Profiler:
+    """Record spans of time spent in a phase of the build.
+
+    Spans are appended to a file as JSON lines, so that processes that read or
+    write pages in parallel record their spans in the same place.
+    """
+
+    def __init__(self, path_report=None, path_trace=None):
+        self.path_report = Path(path_report) if path_report else None
+        self.path_trace = Path(path_trace) if path_trace else None
+        fd, path_spans = tempfile.mkstemp(prefix="jupyter-book-", suffix=".jsonl")
+        os.close(fd)
+        self.path_spans = Path(path_spans)
+        # If the build fails before its spans are read, such as while notebooks
+        # are executed, the file is removed when the profiler is
+        weakref.finalize(self, _remove, self.path_spans)
+        # When the page that is being read started to be read and transformed
+        self.read_start = None
+        self.transforms_start = None
+
+    def record(self, name, docname, start, end):
+        record = {
+            "name": name,
+            "docname": docname,
+            "start": start,
+            "end": end,
+            "pid": os.getpid(),
+        }
+        # Each span is written at once, so spans from parallel processes
+        # aren't mixed up
+        with open(self.path_spans, "a") as ff:
+            ff.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def span(self, name, docname=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, docname, start, time.time())
+
+    def pop_spans(self):
+        """Return the spans recorded so far, and start recording new spans."""
+        if not self.path_spans.exists():
+            return []
+        spans = [json.loads(line) for line in self.path_spans.read_text().splitlines()]
+        self.path_spans.unlink()
+        return spans
+
+
+def _remove(path):
+    if path.exists():
+        path.unlink()
+
+
+@contextmanager
+def span(app, name, docname=None):
+    """Record the time spent in a block of code, if the build is profiled."""
+    profiler = getattr(app, "jupyter_book_profiler", None)
+    if profiler is None:
+        yield
+        return
+    with profiler.span(name, docname):
+        yield
+
+
+def timed(name):
+    """Decorate an event handler to record how long it takes, if profiling."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(app, *args, **kwargs):
+            with span(app, name):
+                return func(app, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class MarkTransformsStart(SphinxTransform):
+    """Record when a page is parsed, and transforms start to be applied."""
+
+    # Before the other transforms
+    default_priority = 1
+
+    def apply(self):
+        profiler = getattr(self.app, "jupyter_book_profiler", None)
+        if profiler is None or profiler.read_start is None:
+            return
+        profiler.transforms_start = time.time()
+        profiler.record(
+            "parse", self.env.docname, profiler.read_start, profiler.transforms_start
+        )
+
+
+def record_transforms(app, doctree):
+    """Record the time spent applying transforms, when `doctree-read` is emitted."""
+    profiler = getattr(app, "jupyter_book_profiler", None)
+    if profiler is None or profiler.transforms_start is None:
+        return
+    profiler.record(
+        "transforms", app.env.docname, profiler.transforms_start, time.time()
+    )
+    profiler.transforms_start = None
+
+
+def init_profiler(app, config):
+    """Start recording the build, if `profile_path` or `trace_path` is set.
+
+    This is connected to `config-inited` before the book's configuration and TOC
+    are loaded, so that loading them is recorded too.
+    """
+    if config["profile_path"] or config["trace_path"]:
+        app.jupyter_book_profiler = Profiler(
+            config["profile_path"], config["trace_path"]
+        )
+
+
+def setup_profiler(app):
+    """Time the phases of reading and writing pages, if the build is profiled."""
+    profiler = getattr(app, "jupyter_book_profiler", None)
+    if profiler is None:
+        return
+    builder = app.builder
+
+    read_doc = builder.read_doc
+
+    def timed_read_doc(docname):
+        profiler.read_start = time.time()
+        try:
+            with profiler.span("read", docname):
+                read_doc(docname)
+        finally:
+            profiler.read_start = None
+
+    write_doc = builder.write_doc
+
+    def timed_write_doc(docname, doctree):
+        with profiler.span("write", docname):
+            write_doc(docname, doctree)
+
+    write = builder.write
+
+    def timed_write(*args, **kwargs):
+        env = builder.env
+        get_and_resolve_doctree = env.get_and_resolve_doctree
+
+        def timed_get_and_resolve_doctree(docname, *args, **kwargs):
+            with profiler.span("resolve", docname):
+                return get_and_resolve_doctree(docname, *args, **kwargs)
+
+        env.get_and_resolve_doctree = timed_get_and_resolve_doctree
+        try:
+            write(*args, **kwargs)
+        finally:
+            # The environment is pickled, so it can't keep the wrapper
+            del env.get_and_resolve_doctree
+
+    build = builder.build
+
+    def timed_build(*args, **kwargs):
+        start = time.time()
+        restore = _time_execution(profiler)
+        try:
+            build(*args, **kwargs)
+        finally:
+            restore()
+            profiler.record("build", None, start, time.time())
+            # This removes the file of spans, even if the build failed
+            spans = profiler.pop_spans()
+        if profiler.path_report:
+            write_report(profiler.path_report, spans)
+        if profiler.path_trace:
+            write_trace(profiler.path_trace, spans)
+
+    builder.read_doc = timed_read_doc
+    builder.write_doc = timed_write_doc
+    builder.write = timed_write
+    builder.build = timed_build
+
+
+def _time_execution(profiler):
+    """Time notebook execution in MyST-NB. Returns a function that undoes this.
+
+    MyST-NB has no events for execution, so its functions that execute
+    notebooks are wrapped. `add_notebook_outputs` is defined in `myst_nb.cache`
+    and imported by name in other modules, such as `myst_nb.parser`, so it's
+    replaced in every MyST-NB module that has it. The functions are private,
+    so a warning is logged if a version of MyST-NB doesn't have them, and
+    execution isn't timed.
+    """
+    try:
+        from myst_nb import cache as nb_cache
+        import myst_nb.parser  # noqa: F401
+    except ImportError:
+        return lambda: None
+
+    names = ["add_notebook_outputs", "_stage_and_execute"]
+    missing = [
+        f"myst_nb.cache.{name}"
+        for name in names
+        if not callable(getattr(nb_cache, name, None))
+    ]
+    if missing:
+        logger.warning(
+            f"Notebook execution isn't profiled, since MyST-NB has no {missing}"
+        )
+        return lambda: None
+
+    add_notebook_outputs = nb_cache.add_notebook_outputs
+    stage_and_execute = nb_cache._stage_and_execute
+
+    def timed_add_notebook_outputs(env, *args, **kwargs):
+        with profiler.span("execute", env.docname):
+            return add_notebook_outputs(env, *args, **kwargs)
+
+    def timed_stage_and_execute(*args, **kwargs):
+        # With the cache, notebooks are executed together before pages are read
+        with profiler.span("execute_notebooks"):
+            return stage_and_execute(*args, **kwargs)
+
+    # The modules that call `add_notebook_outputs` through their own reference
+    modules = [
+        module
+        for name, module in list(sys.modules.items())
+        if name.split(".")[0] == "myst_nb"
+        and getattr(module, "add_notebook_outputs", None) is add_notebook_outputs
+    ]
+
+    def restore():
+        for module in modules:
+            module.add_notebook_outputs = add_notebook_outputs
+        nb_cache._stage_and_execute = stage_and_execute
+
+    for module in modules:
+        module.add_notebook_outputs = timed_add_notebook_outputs
+    nb_cache._stage_and_execute = timed_stage_and_execute
+    return restore
+
+
+def summarize_spans(spans):
+    """Return the total time of each phase, and the time of each phase per page.
+
+    Pages are sorted from slowest to fastest. The total time of a page is the
+    time spent reading, resolving and writing it.
+    """
+    phases = {}
+    documents = {}
+    for record in spans:
+        seconds = record["end"] - record["start"]
+        phases[record["name"]] = phases.get(record["name"], 0) + seconds
+        if record["docname"] is None:
+            continue
+        timings = documents.setdefault(record["docname"], dict.fromkeys(PHASES, 0))
+        timings[record["name"]] += seconds
+
+    for timings in documents.values():
+        timings["total"] = timings["read"] + timings["resolve"] + timings["write"]
+    documents = [
+        dict(docname=docname, **timings)
+        for docname, timings in sorted(
+            documents.items(), key=lambda item: item[1]["total"], reverse=True
+        )
+    ]
+    return phases, documents
+
+
+def write_report(path_report, spans):
+    """Write the profile of a build, and log the slowest pages."""
+    phases, documents = summarize_spans(spans)
+    report = {"phases": phases, "documents": documents, "spans": spans}
+    path_report.parent.mkdir(parents=True, exist_ok=True)
+    path_report.write_text(json.dumps(report, indent=2))
+
+    columns = PHASES + ["total"]
+    width = max([len("whole build")] + [len(doc["docname"]) for doc in documents])
+    header = f"{'page':<{width}}" + "".join(f"{col:>12}" for col in columns)
+    lines = [header]
+    for doc in documents[:N_SLOWEST]:
+        times = "".join(f"{doc[col]:>12.3f}" for col in columns)
+        lines.append(f"{doc['docname']:<{width}}{times}")
+    totals = "".join(f"{phases.get(col, 0):>12.3f}" for col in PHASES)
+    lines.append(f"{'whole build':<{width}}{totals}{phases.get('build', 0):>12.3f}")
+
+    logger.info("")
+    logger.info(bold(f"slowest pages (seconds, {N_SLOWEST} at most):"))
+    for line in lines:
+        logger.info(line)
+    logger.info(f"The build profile was saved in {path_report}")
+
+
+def _trace_event(record):
+    """Return a Chrome trace event that shows a span as a bar on its process' row."""
+    name = record["name"]
+    if record["docname"] is not None:
+        name = f"{name}: {record['docname']}"
+    return {
+        "name": name,
+        "cat": record["name"],
+        "ph": "X",
+        # Times are in microseconds
+        "ts": record["start"] * 1e6,
+        "dur": (record["end"] - record["start"]) * 1e6,
+        "pid": record["pid"],
+        "tid": record["pid"],
+        "args": {"docname": record["docname"]},
+    }
+
+
+def write_trace(path_trace, spans):
+    """Write spans as Chrome trace events, which can be viewed with Perfetto."""
+    main_pid = os.getpid()
+    events = []
+    for ii, pid in enumerate(sorted({record["pid"] for record in spans} - {main_pid})):
+        events.append(_process_name(pid, f"worker {ii + 1}"))
+    events.append(_process_name(main_pid, "main"))
+    events.extend(_trace_event(record) for record in spans)
+
+    path_trace = Path(path_trace)
+    path_trace.parent.mkdir(parents=True, exist_ok=True)
+    path_trace.write_text(json.dumps({"traceEvents": events}))
+    logger.info(f"The build trace was saved in {path_trace}")
+
+
+def _process_name(pid, name):
+    """Return the trace event that names a process' row."""
+    return {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+
+
+@contextmanager
+def trace_step(path_trace, name):
+    """Add the time spent in a block of code to an existing trace.
+
+    This is used for steps that happen after Sphinx is finished, such as
+    converting a book to PDF.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if path_trace is not None and Path(path_trace).exists():
+            record = {
+                "name": name,
+                "docname": None,
+                "start": start,
+                "end": time.time(),
+                "pid": os.getpid(),
+            }
+            trace = json.loads(Path(path_trace).read_text())
+            trace["traceEvents"].append(_trace_event(record))
+            Path(path_trace).write_text(json.dumps(trace))
@@ -0,0 +1,57 @@
+"""A small sphinx extension to only build some of the pages in a book's folder.
+
+When `build_scope` is a list of docnames, only these pages are found, read,
+executed and written. Other files in the book's folder aren't looked at, so
+building one page of a large book doesn't have to list and exclude every other
+file. What was read from the other pages in earlier builds is kept, so that the
+next build of the whole book doesn't read them again.
+"""
+import os
+
+from sphinx.project import EXCLUDE_PATHS, Project
+from sphinx.util.matching import compile_matchers
+
+
+class ScopedProject(Project):
+    """A project that only looks for the documents of a list of docnames."""
+
+    def __init__(self, srcdir, source_suffix, scope):
+        super().__init__(srcdir, source_suffix)
+        self.scope = list(scope)
+
+    def discover(self, exclude_paths=[]):
+        """Find the documents of the scope that exist and aren't excluded."""
+        self.docnames = set()
+        excludes = compile_matchers(list(exclude_paths) + EXCLUDE_PATHS)
+        for docname in self.scope:
+            filename = self.doc2path(docname, basedir=False).replace(os.path.sep, "/")
+            if any(exclude(filename) for exclude in excludes):
+                continue
+            if os.access(os.path.join(self.srcdir, filename), os.R_OK):
+                self.docnames.add(docname)
+        return self.docnames
+
+
+def limit_to_scope(app):
+    """Only find the pages of `build_scope`, if it's set.
+
+    This is connected to `builder-inited`, before the pages are found for the
+    first time, and before notebooks are executed.
+    """
+    scope = app.config["build_scope"]
+    if not scope:
+        return
+    project = ScopedProject(app.srcdir, app.config.source_suffix, scope)
+    app.project = app.env.project = project
+
+
+def keep_out_of_scope(app, env, added, changed, removed):
+    """Don't remove the pages outside of `build_scope` from the environment.
+
+    Sphinx removes the pages that it didn't find, which would be every page
+    outside of the scope. This is connected to `env-get-outdated`.
+    """
+    scope = app.config["build_scope"]
+    if scope:
+        removed.intersection_update(scope)
+    return []
@@ -1,11 +1,16 @@
 """Tools for interacting with Sphinx."""
 import sys
 import os.path as op
-import yaml
 from pathlib import Path
 from sphinx.util.docutils import docutils_namespace, patch_docutils
 from sphinx.application import Sphinx
 from sphinx.cmd.build import handle_exception
+from sphinx.util import logging
+
+from .config import parse_jobs
+from .watch import watch as watch_files
+
+logger = logging.getLogger(__name__)
 
 
 REDIRECT_TEXT = """
@@ -13,6 +18,9 @@ REDIRECT_TEXT = """
 """
 
 ROOT = Path(__file__)
+# Returned by `build_sphinx` when it's watching a book and its configuration or
+# TOC changes
+CONFIG_FILES_CHANGED = "config-files-changed"
 # Some configuration values that are really sphinx-specific
 DEFAULT_CONFIG = dict(
     extensions=[
@@ -61,6 +69,9 @@ def build_sphinx(
     verbosity=0,
     jobs=None,
     keep_going=False,
+    watch=False,
+    profile=False,
+    trace=None,
 ):
     """Sphinx build "main" command-line entry.
 
@@ -74,6 +85,18 @@ def build_sphinx(
         A list of extra extensions to load into Sphinx. This must be done
         before Sphinx is initialized otherwise the extensions aren't properly
         initialized.
+    jobs : int | str | None
+        The number of parallel processes Sphinx uses to read and write pages.
+        If "auto", one process per CPU is used.
+    watch : bool
+        Keep running after the build, and rebuild the pages that change. If the
+        configuration or the TOC changes, `CONFIG_FILES_CHANGED` is returned so
+        that the caller can load them again and start a new build.
+    profile : bool
+        Record how long each phase of the build takes for each page, in
+        `reports/profile.json` next to `outputdir`, and log the slowest pages.
+    trace : str | None
+        Path to write a timeline of the build to, as Chrome trace events.
     """
 
     # Manual configuration overrides
@@ -85,8 +108,8 @@ def build_sphinx(
     if extra_extensions:
         if not isinstance(extra_extensions, list):
             extra_extensions = [extra_extensions]
-        for ext in extra_extensions:
-            config["extensions"].append(ext)
+        # Copied, so that the next build in this process starts from the defaults
+        config["extensions"] = config["extensions"] + extra_extensions
 
     # HTML-specific configuration
     if htmloverrides is None:
@@ -111,8 +134,13 @@ def build_sphinx(
     if not doctreedir:
         doctreedir = Path(outputdir).parent.joinpath(".doctrees")
 
-    if jobs is None:
-        jobs = 1
+    jobs = parse_jobs(jobs)
+
+    if profile:
+        path_profile = Path(outputdir).parent.joinpath("reports", "profile.json")
+        config["profile_path"] = str(path_profile)
+    if trace:
+        config["trace_path"] = str(trace)
 
     # Manually re-building files in filenames
     if filenames is None:
@@ -182,33 +210,53 @@ def build_sphinx(
 
             # Write an index.html file in the root to redirect to the first page
             path_index = outputdir.joinpath("index.html")
-            if config["globaltoc_path"]:
-                path_toc = Path(config["globaltoc_path"])
-                if not path_toc.exists():
-                    raise ValueError(
-                        (
-                            f"You gave a Configuration file path"
-                            "that doesn't exist: {path_toc}"
-                        )
-                    )
-                if path_toc.suffix not in [".yml", ".yaml"]:
-                    raise ValueError(
-                        f"You gave a Configuration file path"
-                        "that is not a YAML file: {path_toc}"
-                    )
-            else:
-                path_toc = None
-
-            if not path_index.exists() and path_toc:
-                toc = yaml.safe_load(path_toc.read_text())
-                if isinstance(toc, dict):
-                    first_page = toc["file"]
-                else:
-                    first_page = toc[0]["file"]
-                first_page = first_page.split(".")[0] + ".html"
+            toc = app.config["globaltoc"] if config["globaltoc_path"] else None
+            if not path_index.exists() and toc:
+                first_page = toc["file"].split(".")[0] + ".html"
                 with open(path_index, "w") as ff:
                     ff.write(REDIRECT_TEXT.format(first_page=first_page))
+
+            if watch:
+                paths_config = [
+                    app.config[key]
+                    for key in ["globaltoc_path", "yaml_config_path"]
+                    if app.config[key]
+                ]
+                if _watch(app, paths_config, debug_args, error):
+                    # A configuration file changed, so the caller starts a new
+                    # build, with everything that comes from it loaded again
+                    return CONFIG_FILES_CHANGED
             return app.statuscode
     except (Exception, KeyboardInterrupt) as exc:
         handle_exception(app, debug_args, exc, error)
         return exc
+
+
+def _watch(app, paths_config, debug_args, error):
+    """Rebuild the outdated pages of a Sphinx app whenever its source files change.
+
+    Returns True if one of `paths_config` changed, and False if stopped with Ctrl-C.
+    """
+
+    def rebuild(changed):
+        from .execute import execute_book_notebooks
+
+        logger.info(f"Files changed, rebuilding: {', '.join(changed)}")
+        try:
+            # Notebooks are executed when the builder is created, which doesn't
+            # happen again, so the notebooks of the pages that changed are
+            # executed here
+            execute_book_notebooks(app)
+            # Sphinx re-reads only the documents that are out of date
+            app.build(False, [])
+        except Exception as exc:
+            handle_exception(app, debug_args, exc, error)
+
+    # Don't watch the build outputs
+    path_outdir = Path(app.outdir)
+    ignore = [path_outdir, Path(app.doctreedir)]
+    if path_outdir.parent.resolve() != Path(app.srcdir).resolve():
+        ignore.append(path_outdir.parent)
+
+    logger.info(f"Watching for changes in {app.srcdir} (press Ctrl-C to stop)...")
+    return watch_files([app.srcdir], rebuild, paths_config=paths_config, ignore=ignore)
@@ -1,6 +1,6 @@
+import yaml
 from pathlib import Path
 from textwrap import dedent
-from jupyter_client.kernelspec import find_kernel_specs
 
 SUPPORTED_FILE_SUFFIXES = [".ipynb", ".md", ".markdown", ".myst", ".Rmd", ".py"]
 
@@ -20,6 +20,107 @@ def _filename_to_title(filename, split_char="_"):
     return title
 
 
+##############################################################################
+# Table of contents
+
+
+def _content_path_to_yaml(path, root_path, split_char="_"):
+    """Return a YAML entry for the TOC from a path."""
+    path = path.with_suffix("")
+    if path.name == "index":
+        title = _filename_to_title(path.resolve().parent.name, split_char=split_char)
+    else:
+        title = _filename_to_title(path.name, split_char=split_char)
+
+    path_rel_root = path.relative_to(root_path)
+    out = {"file": str(path_rel_root.with_suffix("")), "title": title}
+    return out
+
+
+def _find_content_structure(path, root_folder, split_char="_", skip_text=None):
+    """Parse a folder and sub-folders for content and return a dict."""
+    if skip_text is None:
+        skip_text = []
+    skip_text.append(".ipynb_checkpoints")
+
+    path = Path(path)
+
+    # First parse all the content files
+    content_files = [
+        ii for ii in path.iterdir() if ii.suffix in SUPPORTED_FILE_SUFFIXES
+    ]
+
+    if len(content_files) == 0:
+        return
+
+    # First content page (or file called index) will be the parent
+    # Each folder must have at least one content file in it
+    # First see if we have an "index" page
+    first_content = None
+    for ii, ifile in enumerate(content_files):
+        if ifile.with_suffix("").name == "index":
+            first_content = content_files.pop(ii)
+    if not first_content:
+        first_content = content_files.pop(0)
+    parent = _content_path_to_yaml(first_content, root_folder, split_char=split_char)
+    parent["sections"] = []
+
+    # Children become sections of the parent
+    for content_file in content_files:
+        if any(iskip in str(content_file) for iskip in skip_text):
+            continue
+        parent["sections"].append(_content_path_to_yaml(content_file, root_folder))
+
+    # Now recursively run this on folders, and add as another sub-page
+    folders = [ii for ii in path.iterdir() if ii.is_dir()]
+    for folder in folders:
+        if any(iskip in str(folder) for iskip in skip_text):
+            continue
+        folder_out = _find_content_structure(
+            folder, root_folder, split_char=split_char, skip_text=skip_text
+        )
+        if folder_out:
+            parent["sections"].append(folder_out)
+
+    if len(parent["sections"]) == 0:
+        parent.pop("sections")
+    return parent
+
+
+def build_toc(path, filename_split_char="_", skip_text=None):
+    """Auto-generate a Table of Contents from files/folders.
+
+    All file and folder names are ordered alpha-numerically, unless
+    a file name is "index", in which case it is treated as the first
+    file.
+
+    It uses the following logic:
+
+    * In a given folder, the first content page is the folder parent.
+    * All subsequent files are sections of the parent page
+    * For each sub-folder
+        * Its first page is appended to sections of the parent page
+        * All other sub-folder are children of the subfolder's first page
+
+    Parameters
+    ----------
+    path : str
+        Path to the folder where content exists. The TOC will be generated
+        according to the alphanumeric sort of these files/folders.
+    filename_split_char : str
+        The character used in inferring spaces in page names from filenames.
+    skip_text : str | None
+        If this text is found in any files or folders, they will be skipped.
+    """
+    structure = _find_content_structure(
+        path, path, split_char=filename_split_char, skip_text=skip_text
+    )
+    if not structure:
+        raise ValueError(f"No content files were found in {path}.")
+    yaml_out = yaml.safe_dump(structure, default_flow_style=False, sort_keys=False)
+    return yaml_out
+
+
 ##############################################################################
 # CLI utilities
 
@@ -89,6 +190,8 @@ def init_myst_file(path, kernel, verbose=True):
     if not Path(path).exists():
         raise FileNotFoundError(f"Markdown file not found: {path}")
 
+    from jupyter_client.kernelspec import find_kernel_specs
+
     kernels = list(find_kernel_specs().keys())
     kernels_text = "\n".join(kernels)
     if kernel is None:
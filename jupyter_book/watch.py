@@ -0,0 +1,83 @@
+"""Watch a book's files and rebuild it when they change."""
+import os
+import time
+from pathlib import Path
+
+
+def _snapshot(paths, ignore=None):
+    """Return the modification time of every file in a list of files/folders.
+
+    Hidden files and folders, editor backup files, and any folder in `ignore`
+    are skipped.
+    """
+    ignore = [Path(ii).resolve() for ii in ignore or []]
+    mtimes = {}
+    for path in paths:
+        path = Path(path).resolve()
+        if path.is_file():
+            mtimes[str(path)] = path.stat().st_mtime
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [
+                dd
+                for dd in dirs
+                if not dd.startswith(".") and Path(root, dd) not in ignore
+            ]
+            for ff in files:
+                if ff.startswith(".") or ff.endswith("~"):
+                    continue
+                path_file = os.path.join(root, ff)
+                try:
+                    mtimes[path_file] = os.stat(path_file).st_mtime
+                except FileNotFoundError:
+                    # The file was removed while we were looking
+                    continue
+    return mtimes
+
+
+def _changed(old, new):
+    """Return the files that were added, removed or modified between snapshots."""
+    paths = set(old) | set(new)
+    return sorted(path for path in paths if old.get(path) != new.get(path))
+
+
+def watch(paths, build, paths_config=None, ignore=None, interval=0.5):
+    """Call `build` each time files in `paths` change.
+
+    `build` is called with the list of files that changed. Changes to
+    `paths_config` aren't passed to `build`, since changing a configuration file
+    (such as `_config.yml` or `_toc.yml`) requires starting the build again.
+
+    Parameters
+    ----------
+    paths : list
+        Files and folders to watch.
+    build : callable
+        Called with the list of changed files whenever files in `paths` change.
+    paths_config : list | None
+        Configuration files to watch.
+    ignore : list | None
+        Folders in `paths` that won't be watched, such as the build folder.
+    interval : float
+        Time (in seconds) to wait between checking the files.
+
+    Returns
+    -------
+    changed_config : bool
+        True if a configuration file changed, and False if watching was stopped
+        with Ctrl-C.
+    """
+    paths_config = [str(Path(ii).resolve()) for ii in paths_config or []]
+    mtimes = _snapshot(list(paths) + paths_config, ignore)
+    try:
+        while True:
+            time.sleep(interval)
+            new_mtimes = _snapshot(list(paths) + paths_config, ignore)
+            changed = _changed(mtimes, new_mtimes)
+            mtimes = new_mtimes
+            if any(path in paths_config for path in changed):
+                return True
+            if changed:
+                build(changed)
+    except KeyboardInterrupt:
+        return False
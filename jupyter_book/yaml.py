@@ -1,44 +1,30 @@
 """A small sphinx extension to let you configure a site with YAML metadata."""
-from pathlib import Path
-from yaml import safe_load
+from copy import deepcopy
 
-
-# Transform a "Jupyter Book" YAML configuration file into a Sphinx configuration file.
-# This is so that we can choose more user-friendly words for things than Sphinx uses.
-# e.g., 'logo' instead of 'html_logo'.
-# Note that this should only be used for **top level** keys.
-PATH_YAML_DEFAULT = Path(__file__).parent.joinpath("default_config.yml")
+from .config import load_config
+from .profiling import timed
 
 
+@timed("load_config")
 def add_yaml_config(app, config):
     """Load all of the key/vals in a config file into the Sphinx config"""
-    # First load the default YAML config
-    yaml_config = safe_load(PATH_YAML_DEFAULT.read_text())
-
-    # Update the default config with a provided one, if it exists
-    path_yaml = app.config["yaml_config_path"]
-    if len(path_yaml) > 0:
-        path_yaml = Path(path_yaml)
-        if not path_yaml.exists():
-            raise ValueError(
-                f"Path to a _config.yml file was given, but not found: {path_yaml}"
-            )
-
-        # Load the YAML and update its values to translate it into Sphinx keys
-        yaml_update = safe_load(path_yaml.read_text())
-        for key, val in yaml_update.items():
-            # If it's a dictionary, we should just updated the newly-given values
-            if isinstance(yaml_config.get(key), dict):
-                yaml_config[key].update(val)
-            else:
-                yaml_config[key] = val
-
-    # Now update our Sphinx build configuration
-    new_config = yaml_to_sphinx(yaml_config, config)
+    # The command-line interface loads the book's configuration, otherwise we
+    # load it (and merge it into the default configuration) here
+    yaml_config = app.config["yaml_config"]
+    if yaml_config is None:
+        yaml_config, _ = load_config(app.config["yaml_config_path"] or None)
+
+    # Now update our Sphinx build configuration. The translation modifies the
+    # configuration, so it gets a copy.
+    new_config = yaml_to_sphinx(deepcopy(yaml_config), config)
     for key, val in new_config.items():
         config[key] = val
 
 
+# Transform a "Jupyter Book" YAML configuration file into a Sphinx configuration file.
+# This is so that we can choose more user-friendly words for things than Sphinx uses.
+# e.g., 'logo' instead of 'html_logo'.
+# Note that this should only be used for **top level** keys.
 def yaml_to_sphinx(yaml, config):
     """Convert a Jupyter Book style config structure into a Sphinx docs structure."""
     sphinx_config = {
@@ -90,6 +76,22 @@ def yaml_to_sphinx(yaml, config):
         sphinx_config["jupyter_execute_notebooks"] = execute.get("execute_notebooks")
         sphinx_config["jupyter_cache"] = execute.get("cache")
         sphinx_config["execution_excludepatterns"] = execute.get("exclude_patterns")
+        sphinx_config["execution_workers"] = execute.get("workers", 1)
+        sphinx_config["execution_kernel_pool"] = execute.get("kernel_pool", False)
+        sphinx_config["execution_kernel_preload"] = execute.get("kernel_preload", [])
+        sphinx_config["execution_kernel_max_notebooks"] = execute.get(
+            "kernel_max_notebooks", 10
+        )
+        sphinx_config["execution_kernel_setup"] = execute.get("kernel_setup") or ""
+        sphinx_config["execution_dependencies"] = execute.get("dependencies") or {}
+        sphinx_config["execution_sandbox"] = execute.get("sandbox", False)
+        sphinx_config["execution_outputs"] = execute.get("outputs") or {}
+        sphinx_config["execution_checkpoints"] = execute.get("checkpoints", False)
+        sphinx_config["execution_checkpoint_seconds"] = execute.get(
+            "checkpoint_seconds", 10
+        )
+        sphinx_config["execution_checkpoints_kept"] = execute.get("checkpoints_kept", 2)
+        sphinx_config["execution_report_cells"] = execute.get("report_cells", False)
 
     # Update the theme options in the main config
     sphinx_config["html_theme_options"] = theme_options
@@ -20,6 +20,8 @@ test_reqs = [
     "matplotlib",
     "pytest-regressions",
     "jupytext",
+    "dill",
+    "psutil",
 ] + doc_reqs
 setup(
     name="jupyter-book",
@@ -70,6 +72,8 @@ setup(
         "sphinx": doc_reqs,
         "testing": test_reqs,
         "pdfhtml": "pyppeteer",
+        "checkpoints": "dill",
+        "report": "psutil",
     },
     entry_points={
         "console_scripts": [
@@ -0,0 +1,8 @@
+"""Load the dataset that the notebooks of the book use."""
+import os
+
+with open("setups.txt", "a") as ff:
+    ff.write("setup\n")
+
+dataset = list(range(1000))
+setup_pid = os.getpid()
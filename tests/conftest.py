@@ -0,0 +1,20 @@
+"""Fixtures shared by the tests."""
+
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def cell_outputs():
+    """Return a function that reads the outputs of the code cells of an HTML page.
+
+    Each output is returned as its text, split into words.
+    """
+    from bs4 import BeautifulSoup
+
+    def _cell_outputs(path_html):
+        soup = BeautifulSoup(Path(path_html).read_text(), "html.parser")
+        return [div.get_text().split() for div in soup.select("div.cell_output")]
+
+    return _cell_outputs
@@ -1,5 +1,9 @@
+import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
 from subprocess import run, PIPE
+from shutil import copytree, rmtree
+from threading import Thread
 import pytest
 
 
@@ -123,3 +127,332 @@ def test_build_page(tmpdir):
     run(f"jb page {path_page} --path-output {path_output}".split(), check=True)
     path_html = path_output.joinpath("_build", "html")
     assert path_html.joinpath("single_page.html").exists()
+
+
+def test_build_parallel(tmpdir):
+    """Test that parallel and serial builds generate the same HTML."""
+    path = Path(tmpdir).joinpath("mybook").absolute()
+    run(f"jb create {path}".split())
+    # Notebook outputs aren't deterministic (e.g. memory addresses)
+    with path.joinpath("_config.yml").open("a") as ff:
+        ff.write('\nexecute:\n  execute_notebooks: "off"\n')
+    # Sphinx only reads pages in parallel if there are more than 5 of them
+    path.joinpath("extra.md").write_text("# An extra page\n")
+    with path.joinpath("_toc.yml").open("a") as ff:
+        ff.write("- file: extra\n")
+
+    path_serial = Path(tmpdir).joinpath("serial")
+    path_parallel = Path(tmpdir).joinpath("parallel")
+    run(f"jb build {path} --path-output {path_serial} -j 1".split(), check=True)
+    run(f"jb build {path} --path-output {path_parallel} -j 2".split(), check=True)
+
+    path_html_serial = path_serial.joinpath("_build", "html")
+    path_html_parallel = path_parallel.joinpath("_build", "html")
+    pages = sorted(path_html_serial.glob("**/*.html"))
+    assert pages
+    for page in pages:
+        path_page = path_html_parallel.joinpath(page.relative_to(path_html_serial))
+        assert path_page.read_text() == page.read_text()
+
+    # Bad values for jobs raise an error, from the CLI or the config
+    with pytest.raises(ValueError):
+        out = run(f"jb build {path} -j foo".split(), stderr=PIPE)
+        err = out.stderr.decode()
+        if "ValueError" in err:
+            raise ValueError(err)
+    assert "jobs must be a positive integer or 'auto'" in err
+    with path.joinpath("_config.yml").open("a") as ff:
+        ff.write("build:\n  jobs: 0\n")
+    with pytest.raises(ValueError):
+        out = run(f"jb build {path}".split(), stderr=PIPE)
+        err = out.stderr.decode()
+        if "ValueError" in err:
+            raise ValueError(err)
+    assert "jobs must be a positive integer or 'auto', got: 0" in err
+
+    # The same rules apply to the number of notebooks executed at a time
+    with path.joinpath("_config.yml").open("a") as ff:
+        ff.write("execute:\n  workers: -1\n")
+    with pytest.raises(ValueError):
+        out = run(f"jb execute {path}".split(), stderr=PIPE)
+        err = out.stderr.decode()
+        if "ValueError" in err:
+            raise ValueError(err)
+    assert "execute.workers must be a positive integer or 'auto', got: -1" in err
+
+
+def test_build_expand_sections(tmpdir):
+    """Test that sections with expand_sections are expanded in the sidebar."""
+    path_output = Path(tmpdir).absolute()
+    path_book = Path(tmpdir).joinpath("toc")
+    copytree(path_books.joinpath("toc"), path_book)
+    path_toc = path_book.joinpath("_toc_expand.yml")
+    cmd = f"jb build {path_book} --path-output {path_output} --toc {path_toc}"
+    run(cmd.split(), check=True)
+    path_html = path_output.joinpath("_build", "html")
+    assert "subfolder/asubpage.html" in path_html.joinpath("index.html").read_text()
+
+    # Pages that are re-built on their own have expanded sections too, even
+    # though the page with expand_sections isn't read again
+    path_book.joinpath("content2.md").touch()
+    run(cmd.split(), check=True)
+    assert "subfolder/asubpage.html" in path_html.joinpath("content2.html").read_text()
+
+
+def test_build_unchanged_pages(tmpdir):
+    """Test that only pages whose content changed are read again."""
+    path_output = Path(tmpdir).absolute()
+    path_book = Path(tmpdir).joinpath("toc")
+    copytree(path_books.joinpath("toc"), path_book)
+    path_toc = path_book.joinpath("_toc.yml")
+    cmd = f"jb build {path_book} --path-output {path_output} --toc {path_toc}"
+    run(cmd.split(), check=True)
+    path_manifest = path_output.joinpath("_build", ".doctrees", "manifest.json")
+    assert path_manifest.exists()
+
+    # Modified files whose content is the same aren't read again
+    for path in path_book.rglob("*"):
+        path.touch()
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "5 unchanged pages will not be read again" in out
+    assert "reading sources" not in out
+
+    # A page whose sections changed in the TOC is read again, even though its
+    # file didn't change
+    path_toc.write_text(path_toc.read_text().replace("Asubpage", "A sub page"))
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    out_read = out.split("looking for now-outdated files")[0]
+    assert "subfolder/index" in out_read
+    assert "content2" not in out_read
+
+
+def test_build_profile(tmpdir):
+    """Test that profiling a build reports the time spent on each page."""
+    path_output = Path(tmpdir).absolute()
+    path_book = path_books.joinpath("toc")
+    path_toc = path_book.joinpath("_toc.yml")
+    cmd = f"jb build {path_book} --path-output {path_output} --toc {path_toc}"
+    out = run(cmd.split() + ["--profile"], stdout=PIPE, check=True).stdout.decode()
+    assert "slowest pages" in out
+
+    path_report = path_output.joinpath("_build", "reports", "profile.json")
+    report = json.loads(path_report.read_text())
+    docnames = [doc["docname"] for doc in report["documents"]]
+    assert sorted(docnames) == [
+        "content1",
+        "content2",
+        "index",
+        "subfolder/asubpage",
+        "subfolder/index",
+    ]
+    for phase in ["read", "parse", "transforms", "add_toctree", "resolve", "write"]:
+        assert report["phases"][phase] > 0
+    # Pages are sorted from slowest to fastest
+    totals = [doc["total"] for doc in report["documents"]]
+    assert totals == sorted(totals, reverse=True)
+
+
+def test_build_trace(tmpdir):
+    """Test that a build's timeline is written as Chrome trace events."""
+    path_output = Path(tmpdir).absolute()
+    path_book = path_books.joinpath("toc")
+    path_toc = path_book.joinpath("_toc.yml")
+    path_trace = path_output.joinpath("trace.json")
+    cmd = f"jb build {path_book} --path-output {path_output} --toc {path_toc}"
+    run(cmd.split() + ["-j", "2", "--trace", str(path_trace)], check=True)
+
+    events = json.loads(path_trace.read_text())["traceEvents"]
+    phases = {event["cat"] for event in events if event["ph"] == "X"}
+    for phase in ["load_config", "load_toc", "build", "read", "resolve", "write"]:
+        assert phase in phases
+    assert "read: subfolder/index" in [event["name"] for event in events]
+
+    # Each process has its own row, and pages are written by worker processes
+    processes = {
+        event["pid"]: event["args"]["name"] for event in events if event["ph"] == "M"
+    }
+    assert "main" in processes.values()
+    assert "worker 1" in processes.values()
+    pids = {event["pid"] for event in events if event["ph"] == "X"}
+    assert pids == set(processes)
+
+
+def test_build_execute_workers(tmpdir, cell_outputs):
+    """Test that notebooks are executed in parallel, and then read from the cache."""
+    path_book = Path(tmpdir).joinpath("execute_workers").absolute()
+    copytree(path_books.joinpath("execute_workers"), path_book)
+    cmd = f"jb build {path_book}"
+    out = run(cmd.split() + ["--profile"], stdout=PIPE, check=True).stdout.decode()
+    assert "Executing 2 notebooks (0 are cached) with 2 workers" in out
+    assert "Execution Succeeded" not in out
+
+    # The notebooks ran at the same time, and their outputs were rendered
+    intervals = []
+    for name in ["sleep1", "sleep2"]:
+        output = cell_outputs(path_book.joinpath("_build", "html", f"{name}.html"))
+        intervals.append([float(time) for time in output[-1]])
+    (start1, end1), (start2, end2) = intervals
+    assert start1 < end2 and start2 < end1
+
+    # How long they took is reported, slowest first
+    assert "slowest notebooks" in out
+    path_report = path_book.joinpath("_build", "reports", "execution.json")
+    report = json.loads(path_report.read_text())
+    paths = sorted(nb["path"] for nb in report["notebooks"])
+    assert paths == ["sleep1.ipynb", "sleep2.ipynb"]
+    seconds = [nb["seconds"] for nb in report["notebooks"]]
+    assert seconds == sorted(seconds, reverse=True) and min(seconds) > 1
+
+    # The profile has the time each notebook took under its page
+    path_profile = path_book.joinpath("_build", "reports", "profile.json")
+    profile = json.loads(path_profile.read_text())
+    executed = {doc["docname"]: doc["execute"] for doc in profile["documents"]}
+    assert executed["sleep1"] > 1 and executed["sleep2"] > 1
+    assert profile["phases"]["execute_notebooks"] > 1
+
+    # Notebooks that are in the cache aren't executed again
+    path_book.joinpath("_build", ".doctrees", "manifest.json").unlink()
+    path_book.joinpath("sleep1.ipynb").touch()
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "Executing" not in out
+    assert "sleep1" in out
+
+
+def test_build_only(tmpdir):
+    """Test that only the pages given with --only are executed and built."""
+    path_book = Path(tmpdir).joinpath("execute_workers").absolute()
+    copytree(path_books.joinpath("execute_workers"), path_book)
+    cmd = f"jb build {path_book} --only sleep1.ipynb"
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "Executing 1 notebooks" in out
+    assert "sleep2" not in out
+    path_html = path_book.joinpath("_build", "html")
+    assert path_html.joinpath("sleep1.html").exists()
+    assert not path_html.joinpath("sleep2.html").exists()
+    # The first page leads to sleep1, so it's built without sleep2 in its TOC
+    assert "sleep2" not in path_html.joinpath("index.html").read_text()
+
+    # The full build adds sleep2 to every page
+    out = run(f"jb build {path_book}".split(), stdout=PIPE, check=True).stdout.decode()
+    assert "Executing 1 notebooks" in out
+    assert "sleep2" in path_html.joinpath("sleep1.html").read_text()
+
+    # A build of some of the pages keeps what was read from the others
+    run(cmd.split(), check=True)
+    out = run(f"jb build {path_book}".split(), stdout=PIPE, check=True).stdout.decode()
+    assert "0 added, 0 changed, 0 removed" in out
+
+    # Files that aren't in the TOC can't be built
+    out = run(f"jb build {path_book} --only nope".split(), stderr=PIPE)
+    assert "Files aren't in the Table of Contents: ['nope']" in out.stderr.decode()
+
+
+def test_build_cache_url(tmpdir):
+    """Test that executed notebooks and builds are shared through a build cache."""
+    path_cache = Path(tmpdir).joinpath("cache")
+    path_first = Path(tmpdir).joinpath("first", "execute_workers").absolute()
+    copytree(path_books.joinpath("execute_workers"), path_first)
+    cmd = f"jb build {path_first} --cache-url {path_cache} --trust-cache"
+    run(cmd.split(), check=True)
+
+    # A copy of the book somewhere else fetches the notebooks
+    path_book = Path(tmpdir).joinpath("execute_workers").absolute()
+    copytree(path_books.joinpath("execute_workers"), path_book)
+    cmd = f"jb build {path_book} --cache-url {path_cache} --trust-cache"
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "Executing" not in out
+    assert out.count("Fetched from the build cache") == 2
+
+    # Builds are only shared through a cache that is trusted
+    rmtree(path_book.joinpath("_build"))
+    cmd_untrusted = f"jb build {path_book} --cache-url {path_cache}"
+    out = run(cmd_untrusted.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "Restored the last build" not in out
+    assert "Executing" not in out
+
+    # The book in the same place starts from the last build, and only the page
+    # that changed is read again
+    rmtree(path_book.joinpath("_build"))
+    path_nb = path_book.joinpath("sleep2.ipynb")
+    path_nb.write_text(path_nb.read_text().replace("sleep(2)", "sleep(1)"))
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "Restored the last build from the build cache" in out
+    assert "Executing 1 notebooks" in out
+    assert "index" not in out.split("reading sources")[-1].split("\n")[0]
+    assert path_book.joinpath("_build", "html", "sleep1.html").exists()
+
+    # Other kinds of caches aren't supported
+    cmd = f"jb build {path_book} --cache-url s3://bucket/cache"
+    out = run(cmd.split(), stderr=PIPE)
+    assert "A build cache must be a folder or an http(s):// URL" in out.stderr.decode()
+
+
+class _CacheServer(BaseHTTPRequestHandler):
+    """An HTTP build cache, which keeps what is PUT in memory."""
+
+    stored = {}
+
+    def do_GET(self):
+        if self.path not in self.stored:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.stored[self.path])))
+        self.end_headers()
+        self.wfile.write(self.stored[self.path])
+
+    def do_PUT(self):
+        self.stored[self.path] = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_build_cache_url_http(tmpdir):
+    """Test that executed notebooks are shared through an HTTP build cache."""
+    server = HTTPServer(("127.0.0.1", 0), _CacheServer)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/cache"
+    try:
+        path_first = Path(tmpdir).joinpath("first", "execute_workers").absolute()
+        copytree(path_books.joinpath("execute_workers"), path_first)
+        run(f"jb execute {path_first} --cache-url {url}".split(), check=True)
+        assert len(_CacheServer.stored) == 2
+
+        path_book = Path(tmpdir).joinpath("execute_workers").absolute()
+        copytree(path_books.joinpath("execute_workers"), path_book)
+        cmd = f"jb build {path_book} --cache-url {url}"
+        out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+        assert "Executing" not in out
+        assert out.count("Fetched from the build cache") == 2
+    finally:
+        server.shutdown()
+
+
+def test_build_execute_sandbox(tmpdir, cell_outputs):
+    """Test that notebooks executed at the same time don't share their files."""
+    path_book = Path(tmpdir).joinpath("sandbox").absolute()
+    copytree(path_books.joinpath("sandbox"), path_book)
+    out = run(f"jb build {path_book}".split(), stderr=PIPE, check=True)
+    err = out.stderr.decode()
+    assert "The whole book is copied" in err and "(2 notebooks)" in err
+
+    # Each notebook read the scratch file it wrote, and the files in its folder
+    for name in ["first", "second"]:
+        output = cell_outputs(path_book.joinpath("_build", "html", f"{name}.html"))
+        assert output[-1] == [name, "input", "data"]
+
+    # Only the files that the notebooks write are copied back
+    assert path_book.joinpath("first_result.txt").read_text() == "first result"
+    path_result = path_book.joinpath("results", "second_result.txt")
+    assert path_result.read_text() == "second result"
+    assert not path_book.joinpath("scratch.txt").exists()
+    # Patterns of outputs are relative to the book's folder, as dependencies are
+    path_result = path_book.joinpath("chapter", "third_result.txt")
+    assert path_result.read_text() == "third result"
+    assert not path_book.joinpath("chapter", "third_scratch.txt").exists()
+    # The sandboxes of the notebooks at the book's root were in its build folder
+    assert not list(Path(tmpdir).glob(".jupyter-book-sandbox-*"))
+    assert not list(path_book.joinpath("_build").glob(".jupyter-book-sandbox-*"))
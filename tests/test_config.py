@@ -0,0 +1,52 @@
+"""Testing loading a book's configuration and table of contents."""
+from pathlib import Path
+import pytest
+
+from jupyter_book.config import load_config, load_toc
+
+path_books = Path(__file__).parent.joinpath("books")
+
+
+def test_load_config():
+    """Test that a book's configuration is merged into the default one."""
+    path_config = path_books.joinpath("config", "_config.yml")
+    config, config_user = load_config(path_config)
+    assert config_user["sphinx"]["extra_extensions"] == ["sphinx_tabs.tabs"]
+    assert config["sphinx"]["config"] == {"html_title": "TEST PROJECT NAME"}
+    # Values that aren't in the book's configuration come from the default
+    assert "title" not in config_user
+    assert config["title"] == "My Jupyter Book"
+
+    default, default_user = load_config()
+    assert default_user == {}
+    assert default["sphinx"]["config"] == ""
+
+    with pytest.raises(ValueError, match="not found"):
+        load_config(path_books.joinpath("doesnt", "exist.yml"))
+
+
+def test_load_config_workers(tmpdir):
+    """Test that execute.workers is checked and converted when it is loaded."""
+    from multiprocessing import cpu_count
+
+    path_config = Path(tmpdir).joinpath("_config.yml")
+    for workers, expected in [("'4'", 4), ("auto", cpu_count()), (2, 2)]:
+        path_config.write_text(f"execute:\n  workers: {workers}\n")
+        config, _ = load_config(path_config)
+        assert config["execute"]["workers"] == expected
+
+    for workers in [0, -2, "'four'"]:
+        path_config.write_text(f"execute:\n  workers: {workers}\n")
+        with pytest.raises(ValueError, match="execute.workers must be a positive"):
+            load_config(path_config)
+
+
+def test_load_toc(tmpdir):
+    """Test that a flat TOC's first page contains the other pages."""
+    path_toc = Path(tmpdir).joinpath("_toc.yml")
+    path_toc.write_text("- file: index\n- file: page1\n- file: page2\n")
+    toc = load_toc(path_toc)
+    assert toc == {"file": "index", "sections": [{"file": "page1"}, {"file": "page2"}]}
+
+    with pytest.raises(ValueError, match="not a YAML file"):
+        load_toc(path_books.joinpath("toc", "index.md"))
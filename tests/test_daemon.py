@@ -0,0 +1,46 @@
+"""Testing building books with the build daemon."""
+import os
+import sys
+import time
+from pathlib import Path
+from subprocess import run, Popen, PIPE
+
+
+def test_daemon(tmpdir):
+    path = Path(tmpdir).joinpath("mybook").absolute()
+    run(f"jb create {path}".split(), check=True)
+
+    path_socket = Path(tmpdir).joinpath("jb.sock")
+    env = dict(os.environ, JUPYTER_BOOK_DAEMON=str(path_socket))
+    daemon = Popen("jb daemon start".split(), env=env, stdout=PIPE, stderr=PIPE)
+    try:
+        for _ in range(100):
+            if path_socket.exists():
+                break
+            time.sleep(0.1)
+        assert path_socket.exists()
+
+        # Builds are forwarded to the daemon, along with their output
+        out = run(f"jb build {path}".split(), env=env, stdout=PIPE, check=True)
+        assert "Finished generating HTML for book" in out.stdout.decode()
+        assert path.joinpath("_build", "html", "intro.html").exists()
+
+        # The parsed arguments are forwarded, not the script's own
+        code = f"from jupyter_book.commands import main; main(['build', '{path}'])"
+        cmd = [sys.executable, "-c", code, "--unrelated"]
+        out = run(cmd, env=env, stdout=PIPE, check=True)
+        assert "Finished generating HTML for book" in out.stdout.decode()
+
+        # Only the socket's user can connect to it
+        assert oct(path_socket.stat().st_mode & 0o777) == "0o600"
+
+        # Errors are forwarded too
+        out = run("jb build doesnt/exist".split(), env=env, stderr=PIPE)
+        assert out.returncode != 0
+        assert "Path to book isn't a directory" in out.stderr.decode()
+
+        run("jb daemon stop".split(), env=env, check=True)
+        daemon.wait(timeout=10)
+        assert not path_socket.exists()
+    finally:
+        daemon.kill()
@@ -0,0 +1,231 @@
+"""Testing the execution of a book's notebooks with the CLI."""
+
+import os
+import re
+from pathlib import Path
+from subprocess import run, PIPE
+from shutil import copytree
+import pytest
+
+from jupyter_book.execute import ExecutionProgress, schedule_notebooks
+
+path_tests = Path(__file__).parent.resolve()
+path_books = path_tests.joinpath("books")
+
+
+def test_execute_book(tmpdir):
+    """Test that notebooks are executed into the cache, and the build uses it."""
+    path_book = Path(tmpdir).joinpath("execute_workers").absolute()
+    copytree(path_books.joinpath("execute_workers"), path_book)
+
+    # Only the notebooks of one shard are executed
+    out = run(f"jb execute {path_book} --shard 2/2".split(), stdout=PIPE, check=True)
+    out = out.stdout.decode()
+    assert "0 notebooks were in the cache, 1 were executed (0 failed)" in out
+    assert "sleep2.ipynb" in out and "sleep1.ipynb" not in out
+
+    out = run(f"jb execute {path_book}".split(), stdout=PIPE, check=True)
+    out = out.stdout.decode()
+    assert "1 notebooks were in the cache, 1 were executed (0 failed)" in out
+    assert path_book.joinpath("_build", ".jupyter_cache").exists()
+
+    # Notebooks that were executed before are scheduled from their past timings
+    path_nb = path_book.joinpath("sleep1.ipynb")
+    path_nb.write_text(path_nb.read_text().replace("# Notebook 1", "# Notebook 1b"))
+    out = run(f"jb execute {path_book}".split(), stdout=PIPE, check=True)
+    assert "predicted from past executions" in out.stdout.decode()
+
+    # The book is built from the cache, without executing notebooks
+    out = run(f"jb build {path_book}".split(), stdout=PIPE, check=True)
+    assert "Executing" not in out.stdout.decode()
+
+    # === Expected errors ===
+    with pytest.raises(ValueError):
+        out = run(f"jb execute {path_book} --shard 3/2".split(), stderr=PIPE)
+        err = out.stderr.decode()
+        if "ValueError" in err:
+            raise ValueError(err)
+    assert "--shard must look like '2/4'" in err
+
+
+def test_schedule_notebooks():
+    """Test that the longest notebooks are started first."""
+    durations = {"a": 10, "b": 1, "c": 1, "d": 8}
+    order, makespan = schedule_notebooks(["b", "c", "d", "a"], durations, workers=2)
+    assert order == ["a", "d", "b", "c"]
+    assert makespan == 10
+
+    # Notebooks that were never executed are expected to take the average time
+    order, makespan = schedule_notebooks(["b", "e", "a"], durations, workers=1)
+    assert order == ["a", "e", "b"]
+    assert makespan == 10 + 5 + 1
+
+    assert schedule_notebooks(["e"], durations={}, workers=2) == (["e"], None)
+
+
+def test_execute_kernel_pool(tmpdir, cell_outputs):
+    """Test that kernels are kept running between notebooks, and reset for each."""
+    path_book = Path(tmpdir).joinpath("kernel_pool").absolute()
+    copytree(path_books.joinpath("kernel_pool"), path_book)
+    run(f"jb execute {path_book}".split(), check=True)
+    out = run(f"jb build {path_book}".split(), stdout=PIPE, check=True)
+    assert "Executing" not in out.stdout.decode()
+
+    outputs = {}
+    for name in ["first", "subfolder/second", "third"]:
+        output = cell_outputs(path_book.joinpath("_build", "html", f"{name}.html"))
+        outputs[name] = output[-1]
+    # The same kernel executes two notebooks, in their folder and with the
+    # preloaded modules, and then it's restarted
+    assert outputs["first"][1:] == ["False", "kernel_pool", "True"]
+    assert outputs["subfolder/second"][1:] == ["False", "subfolder", "True"]
+    assert outputs["first"][0] == outputs["subfolder/second"][0]
+    assert outputs["third"][0] != outputs["first"][0]
+
+
+def test_execute_dependencies(tmpdir):
+    """Test that notebooks are executed again when the files they read change."""
+    path_book = Path(tmpdir).joinpath("dependencies").absolute()
+    copytree(path_books.joinpath("dependencies"), path_book)
+    cmd = f"jb execute {path_book}"
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "0 notebooks were in the cache, 2 were executed" in out
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "2 notebooks were in the cache, 0 were executed" in out
+
+    # Dependencies from the configuration
+    path_data = path_book.joinpath("data", "values.csv")
+    path_data.write_text(path_data.read_text() + "second,2\n")
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "1 notebooks were in the cache, 1 were executed" in out
+    assert re.search(r"succeeded +\S+  table.ipynb", out)
+
+    # Dependencies from the notebook's metadata
+    path_book.joinpath("data", "more_notes.txt").write_text("More notes\n")
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "1 notebooks were in the cache, 1 were executed" in out
+    assert re.search(r"succeeded +\S+  notes.ipynb", out)
+
+
+def test_execute_upstream(tmpdir):
+    """Test that notebooks are executed after the notebooks they need."""
+    path_book = Path(tmpdir).joinpath("upstream").absolute()
+    copytree(path_books.joinpath("upstream"), path_book)
+    cmd = f"jb execute {path_book}"
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "0 notebooks were in the cache, 2 were executed (0 failed)" in out
+
+    # Notebooks are executed again when a notebook they need changes
+    path_nb = path_book.joinpath("prepare.ipynb")
+    path_nb.write_text(path_nb.read_text().replace("prepared data", "new data"))
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "0 notebooks were in the cache, 2 were executed (0 failed)" in out
+
+    # ... and aren't executed if it fails
+    path_nb.write_text(path_nb.read_text().replace('open(\\"prepared', 'open(\\"a/b'))
+    out = run(cmd.split(), stderr=PIPE).stderr.decode()
+    assert "2 were executed (2 failed)" in out
+
+
+def test_execution_progress():
+    """Test that the time left is predicted from past and current executions."""
+    durations = {"a": 10, "b": 20, "c": 30}
+    progress = ExecutionProgress(["c", "b", "a"], durations, {}, workers=2)
+    progress.start("c", now=0)
+    progress.start("b", now=0)
+    status = progress.status(now=5)
+    assert status == "0/3 notebooks executed, running: c (5s), b (5s), about 25s left"
+    progress.finish("b", 20)
+    progress.start("a", now=20)
+    assert progress.status(now=22).endswith("running: c (22s), a (2s), about 8s left")
+
+    # Without past executions, the time left is only known once notebooks finish
+    progress = ExecutionProgress(["x", "y"], {}, {"y": {"x"}}, workers=2)
+    progress.start("x", now=0)
+    assert progress.status(now=90) == "0/2 notebooks executed, running: x (1m 30s)"
+    progress.finish("x", 90)
+    assert progress.status(now=90) == "1/2 notebooks executed, about 1m 30s left"
+
+
+def test_schedule_upstream():
+    """Test that notebooks that other notebooks need are started first."""
+    durations = {"a": 1, "b": 5, "c": 4}
+    upstream = {"a": set(), "b": {"a"}, "c": set()}
+    order, makespan = schedule_notebooks(["c", "b", "a"], durations, 2, upstream)
+    assert order == ["a", "b", "c"]
+    assert makespan == 6
+
+
+def test_execute_checkpoints(tmpdir):
+    """Test that notebooks that change are executed from their last checkpoint."""
+    pytest.importorskip("dill")
+    path_book = Path(tmpdir).joinpath("checkpoints").absolute()
+    copytree(path_books.joinpath("checkpoints"), path_book)
+    cmd = f"jb execute {path_book}"
+    run(cmd.split(), check=True)
+
+    # Only the cell that changed is executed again
+    path_nb = path_book.joinpath("model.ipynb")
+    path_nb.write_text(path_nb.read_text().replace("predict(2)", "predict(3)"))
+    out = run(cmd.split(), stdout=PIPE, check=True).stdout.decode()
+    assert "0 notebooks were in the cache, 1 were executed (0 failed)" in out
+    assert path_book.joinpath("loads.txt").read_text() == "loaded\n"
+
+    out = run(f"jb build {path_book}".split(), stdout=PIPE, check=True)
+    assert "Executing" not in out.stdout.decode()
+    html = path_book.joinpath("_build", "html", "model.html").read_text()
+    assert "prediction: 18" in html
+
+    # Every cell is executed when a checkpoint can't be restored
+    path_checkpoints = path_book.joinpath("_build", ".jupyter_cache", "checkpoints")
+    for path_state in path_checkpoints.glob("*/*.pkl"):
+        path_state.write_text("not a checkpoint")
+    path_nb.write_text(path_nb.read_text().replace("predict(3)", "predict(4)"))
+    run(cmd.split(), check=True)
+    assert path_book.joinpath("loads.txt").read_text() == "loaded\nloaded\n"
+
+    # The last cell of a notebook that took `checkpoint_seconds` is checkpointed,
+    # even if it ran quickly, so that cells appended to the notebook can be
+    # executed from it
+    path_config = path_book.joinpath("_config.yml")
+    path_config.write_text(path_config.read_text().replace(": 0", ": 1"))
+    text = path_nb.read_text().replace("[1, 2, 3]", "[1, 2, 3]; time.sleep(1)")
+    path_nb.write_text(text.replace('"# Loading', '"import time\\n", "# Loading'))
+    run(cmd.split(), check=True)
+    assert len(list(path_checkpoints.glob("*/*.pkl"))) == 2
+
+    # Only the last `checkpoints_kept` checkpoints are kept
+    path_config.write_text(path_config.read_text() + "  checkpoints_kept: 1\n")
+    path_nb.write_text(path_nb.read_text().replace("predict(4)", "predict(5)"))
+    run(cmd.split(), check=True)
+    assert len(list(path_checkpoints.glob("*/*.pkl"))) == 1
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="kernels can't be forked")
+def test_execute_kernel_setup(tmpdir, cell_outputs):
+    """Test that kernels are forked from a process that ran the setup script."""
+    path_book = Path(tmpdir).joinpath("kernel_setup").absolute()
+    copytree(path_books.joinpath("kernel_setup"), path_book)
+    run(f"jb execute {path_book}".split(), check=True)
+    assert path_book.joinpath("setups.txt").read_text() == "setup\n"
+    out = run(f"jb build {path_book}".split(), stdout=PIPE, check=True)
+    assert "Executing" not in out.stdout.decode()
+
+    for name, folder in [("first", "kernel_setup"), ("chapter/second", "chapter")]:
+        output = cell_outputs(path_book.joinpath("_build", "html", f"{name}.html"))
+        assert output[-1] == ["1000", "True", folder]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="kernels can't be forked")
+def test_execute_kernel_setup_timeout(tmpdir):
+    """Test that a setup script that runs for too long doesn't stop the build."""
+    path_book = Path(tmpdir).joinpath("kernel_setup").absolute()
+    copytree(path_books.joinpath("kernel_setup"), path_book)
+    path_setup = path_book.joinpath("setup_kernel.py")
+    path_setup.write_text("import time\ntime.sleep(600)\n")
+    with path_book.joinpath("_config.yml").open("a") as ff:
+        ff.write("sphinx:\n  config:\n    execution_timeout: 2\n")
+    out = run(f"jb build {path_book}".split(), stdout=PIPE, stderr=PIPE, timeout=300)
+    err = out.stderr.decode()
+    assert "The setup script ran for longer than 2 seconds" in err
+    assert "so the setup script is run for each notebook" in err
@@ -0,0 +1,42 @@
+"""Testing that the command-line interface starts without the build dependencies."""
+
+import sys
+from subprocess import run, PIPE
+
+import pytest
+
+# Modules that only building a book should import
+HEAVY_MODULES = ["sphinx", "docutils", "jupyter_client", "nbformat", "myst_nb"]
+
+
+def test_import_cli():
+    """Test that the CLI starts without importing the build dependencies."""
+    out = run(
+        [sys.executable, "-m", "jupyter_book.commands", "--help"],
+        stdout=PIPE,
+        check=True,
+    )
+    assert "Build and manage books with Jupyter." in out.stdout.decode()
+
+    code = "import sys, jupyter_book.commands; print(' '.join(sys.modules))"
+    out = run([sys.executable, "-c", code], stdout=PIPE, check=True)
+    modules = out.stdout.decode().split()
+    imported_heavy = [name for name in modules if name.split(".")[0] in HEAVY_MODULES]
+    assert imported_heavy == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs 3.7")
+def test_import_time():
+    """Test that importing the CLI is quick, with a lenient limit."""
+    out = run(
+        [sys.executable, "-X", "importtime", "-c", "import jupyter_book.commands"],
+        stderr=PIPE,
+        check=True,
+    )
+    # Lines look like "import time: self [us] | cumulative | imported package"
+    cumulative = {}
+    for line in out.stderr.decode().splitlines()[1:]:
+        _, microseconds, name = line.split("|")
+        cumulative[name.strip()] = int(microseconds)
+    # It's about 0.1s, and importing Sphinx alone takes longer than the limit
+    assert cumulative["jupyter_book.commands"] < 0.5e6
@@ -3,6 +3,8 @@ from subprocess import run, PIPE
 import pytest
 import yaml
 
+from jupyter_book.toc import _index_toc
+
 
 def test_toc():
     path_book = Path(__file__).parent.joinpath("books", "toc")
@@ -18,3 +20,33 @@ def test_toc():
         if "ValueError" in err:
             raise ValueError(err)
     assert "No content files were found in" in err
+
+
+def test_toc_index():
+    """Test looking up pages, their parents and neighbours in the TOC."""
+    toc = {
+        "file": "index",
+        "sections": [
+            {"header": "A header"},
+            {"file": "content1.ipynb", "sections": [{"file": "sub/page"}]},
+            {"file": "content2.md"},
+        ],
+    }
+    index = _index_toc(toc)
+    assert list(index) == ["index", "content1", "sub/page", "content2"]
+    assert index["index"]["children"] == ["content1", "content2"]
+    assert index["index"]["parent"] is None
+    assert index["index"]["prev"] is None
+    assert index["sub/page"]["parent"] == "content1"
+    assert index["sub/page"]["prev"] == "content1"
+    assert index["sub/page"]["next"] == "content2"
+    assert index["content2"]["next"] is None
+    assert index["content1"]["page"] is toc["sections"][1]
+    assert index["index"]["toctrees"] == [
+        {
+            "caption": "A header",
+            "entries": [(None, "content1"), (None, "content2")],
+            "numbered": False,
+        }
+    ]
+    assert index["content2"]["toctrees"] == []
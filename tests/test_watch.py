@@ -0,0 +1,117 @@
+"""Testing rebuilding books when their files change."""
+import os
+import time
+from pathlib import Path
+from shutil import copytree
+from subprocess import run, Popen, PIPE, STDOUT
+from threading import Thread
+
+from jupyter_book.watch import watch
+
+path_books = Path(__file__).parent.resolve().joinpath("books")
+
+
+def _modify(path, text):
+    """Write to a file, and make sure its modification time changes."""
+    mtime = path.stat().st_mtime if path.exists() else time.time()
+    path.write_text(text)
+    os.utime(path, (mtime + 1, mtime + 1))
+
+
+def test_watch(tmpdir):
+    path = Path(tmpdir)
+    path_page = path.joinpath("page.md")
+    path_page.write_text("# A page")
+    path_build = path.joinpath("_build")
+    path_build.mkdir()
+    path_config = path.joinpath("_config.yml")
+    path_config.write_text("title: A book")
+
+    changes = []
+    result = []
+    thread = Thread(
+        target=lambda: result.append(
+            watch(
+                [path],
+                changes.append,
+                paths_config=[path_config],
+                ignore=[path_build],
+                interval=0.05,
+            )
+        )
+    )
+    thread.start()
+    time.sleep(0.2)
+
+    # Changed pages are rebuilt, files in the build folder aren't watched
+    _modify(path_page, "# A changed page")
+    _modify(path_build.joinpath("page.html"), "<h1>A changed page</h1>")
+    _modify(path.joinpath(".hidden"), "hidden")
+    time.sleep(0.2)
+    assert changes == [[str(path_page.resolve())]]
+
+    # Changing the config stops watching so that the build can start again
+    _modify(path_config, "title: A changed book")
+    thread.join(timeout=5)
+    assert result == [True]
+    assert len(changes) == 1
+
+
+class _WatchedBuild:
+    """A `jb build --watch` process, and what it printed."""
+
+    def __init__(self, path):
+        self.proc = Popen(
+            f"jb build {path} --watch".split(),
+            stdout=PIPE,
+            stderr=STDOUT,
+            universal_newlines=True,
+        )
+        self.lines = []
+        Thread(target=lambda: self.lines.extend(self.proc.stdout), daemon=True).start()
+
+    def wait_for(self, text, count=1):
+        """Wait until `text` was printed `count` times."""
+        deadline = time.time() + 120
+        while sum(text in line for line in self.lines) < count:
+            running = self.proc.poll() is None
+            assert time.time() < deadline and running, "".join(self.lines)
+            time.sleep(0.1)
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def test_build_watch_config(tmpdir):
+    """Test that the build starts again with the new configuration when it changes."""
+    path = Path(tmpdir).joinpath("mybook").absolute()
+    run(f"jb create {path}".split(), check=True)
+    build = _WatchedBuild(path)
+    try:
+        build.wait_for("Watching for changes")
+        path_config = path.joinpath("_config.yml")
+        _modify(path_config, path_config.read_text() + 'copyright: "1999"\n')
+        build.wait_for("Configuration changed, restarting the build")
+        build.wait_for("Watching for changes", 2)
+        html = path.joinpath("_build", "html", "intro.html").read_text()
+        assert "Copyright 1999" in html
+    finally:
+        build.stop()
+
+
+def test_build_watch_dependencies(tmpdir):
+    """Test that notebooks are executed again when the files they read change."""
+    path = Path(tmpdir).joinpath("dependencies").absolute()
+    copytree(path_books.joinpath("dependencies"), path)
+    build = _WatchedBuild(path)
+    try:
+        build.wait_for("Watching for changes")
+        path_data = path.joinpath("data", "values.csv")
+        _modify(path_data, path_data.read_text() + "watched,42\n")
+        build.wait_for("build succeeded", 2)
+        assert "Executing 1 notebooks (0 are cached)" in "".join(build.lines)
+        html = path.joinpath("_build", "html", "table.html").read_text()
+        assert "watched,42" in html
+    finally:
+        build.stop()